@@ -0,0 +1,249 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from queue import Empty
+
+from pdfEngines import ENGINE_NAMES, pymupdf_available, import_pymupdf
+
+# Compares the PDF engines (see pdfEngines) on one synthetic batch: wall time,
+# peak memory, output size, and whether the stamp lands in the same place on
+# every sheet. Each engine runs in its own process so peak memory is its own.
+#
+#   python benchmarkEngines.py --people 10 --sheets 4 --fit
+
+STAMP_COLOUR = (230, 20, 20)
+
+# Function to write a vector-heavy drawing package: every sheet has a grid,
+# a few thousand line segments and some text, like an exported CAD layout
+def make_layout_pdf(pdf_path, sheets, page_size, rotate=0, seed=0):
+    import random
+    from reportlab.pdfgen import canvas
+
+    rng = random.Random(seed)
+    c = canvas.Canvas(pdf_path, pagesize=page_size)
+    width, height = page_size
+    for sheet in range(sheets):
+        if rotate:
+            c.setPageRotation(rotate)
+        c.setLineWidth(0.3)
+        for x in range(0, int(width), 20):
+            c.line(x, 0, x, height)
+        for y in range(0, int(height), 20):
+            c.line(0, y, width, y)
+        for _ in range(3000):
+            c.line(rng.uniform(0, width), rng.uniform(0, height), rng.uniform(0, width), rng.uniform(0, height))
+        c.setFont("Helvetica", 10)
+        for line in range(40):
+            c.drawString(30, 30 + line * 12, f"Sheet {sheet + 1} note {line}: cable route, pit and duct details")
+        c.showPage()
+    c.save()
+
+def make_photo(image_path, width, height, seed):
+    from PIL import Image
+
+    noise = [Image.effect_noise((width, height), 40 + 10 * channel + seed % 7) for channel in range(3)]
+    Image.merge('RGB', noise).save(image_path, quality=85)
+
+# Solid stamp with a transparent border, so the alpha mask is exercised too
+def make_stamp(stamp_path):
+    from PIL import Image
+
+    stamp = Image.new('RGBA', (700, 350), (0, 0, 0, 0))
+    stamp.paste(Image.new('RGBA', (660, 310), STAMP_COLOUR + (255,)), (20, 20))
+    stamp.save(stamp_path)
+
+# Function to build the synthetic batch; returns [(layout_pdf, [image paths])]
+def make_synthetic_batch(batch_folder, people, sheets, photos):
+    from reportlab.lib.pagesizes import A3, A4, landscape, portrait
+
+    # Landscape A4/A3 sheets, and portrait A4 sheets turned with /Rotate 90
+    page_setups = [(landscape(A4), 0), (landscape(A3), 0), (portrait(A4), 90)]
+
+    jobs = []
+    for person in range(1, people + 1):
+        person_folder = os.path.join(batch_folder, f"{person}_Person {person}")
+        os.makedirs(person_folder, exist_ok=True)
+
+        page_size, rotate = page_setups[person % len(page_setups)]
+        layout_pdf = os.path.join(person_folder, f"Layout{person}.pdf")
+        make_layout_pdf(layout_pdf, sheets, page_size, rotate, seed=person)
+
+        image_files = []
+        for photo in range(photos):
+            image_path = os.path.join(person_folder, f"photo{photo}.jpg")
+            make_photo(image_path, 2000 + 200 * photo, 1500, seed=person * 10 + photo)
+            image_files.append(image_path)
+        jobs.append((layout_pdf, image_files))
+    return jobs
+
+# Peak resident memory of this process in MB, or None if it can't be read here.
+# On Linux ru_maxrss is carried across exec, so a spawned child would report its
+# parent's peak if that was higher; VmHWM belongs to the child's own address space.
+def peak_memory_mb():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / (1024 * 1024)
+    except (ImportError, AttributeError):
+        pass
+    if sys.platform == 'darwin':
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024)
+    return None
+
+# Runs in a child process: endorse every job with one engine
+def run_engine(engine_name, jobs, stamp_path, output_folder, fit_to_page, optimise, results):
+    from run import process_pdf_with_stamp_and_images, endorsed_output_path
+
+    os.makedirs(output_folder, exist_ok=True)
+    started = time.perf_counter()
+    for layout_pdf, image_files in jobs:
+        process_pdf_with_stamp_and_images(layout_pdf, image_files, stamp_path, endorsed_output_path(layout_pdf, output_folder),
+                                          optimise, fit_to_page, engine_name)
+    results.put((time.perf_counter() - started, peak_memory_mb()))
+
+# Function to render one page to a PIL image with whichever rasteriser is installed
+def render_page(pdf_path, page_number, dpi=72):
+    from PIL import Image
+
+    if pymupdf_available():
+        pymupdf = import_pymupdf()
+        with pymupdf.open(pdf_path) as document:
+            pixmap = document[page_number].get_pixmap(dpi=dpi)
+            return Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples)
+
+    import pypdfium2
+    document = pypdfium2.PdfDocument(pdf_path)
+    return document[page_number].render(scale=dpi / 72).to_pil().convert('RGB')
+
+# Bounding box (in points) of the stamp colour on a rendered page, or None if it isn't visible
+def find_stamp_box(image, dpi=72):
+    from PIL import ImageChops
+
+    red, green, blue = image.split()
+    is_red = red.point(lambda v: 255 if v > 180 else 0)
+    not_green = green.point(lambda v: 255 if v < 90 else 0)
+    not_blue = blue.point(lambda v: 255 if v < 90 else 0)
+
+    box = ImageChops.multiply(ImageChops.multiply(is_red, not_green), not_blue).getbbox()
+    if box is None:
+        return None
+    return tuple(value * 72 / dpi for value in box)
+
+# Function to compare stamp placement on every sheet page against the reference engine.
+# Returns (sheets compared, sheets differing by more than tolerance points, largest offset)
+def compare_stamps(reference_folder, other_folder, jobs, sheets, tolerance=2.0):
+    from run import endorsed_output_path
+
+    compared = mismatched = 0
+    worst = 0.0
+    for layout_pdf, _ in jobs:
+        reference_pdf = endorsed_output_path(layout_pdf, reference_folder)
+        other_pdf = endorsed_output_path(layout_pdf, other_folder)
+        for page_number in range(sheets):
+            reference_box = find_stamp_box(render_page(reference_pdf, page_number))
+            other_box = find_stamp_box(render_page(other_pdf, page_number))
+            compared += 1
+
+            if reference_box is None or other_box is None:
+                if reference_box != other_box:
+                    mismatched += 1
+                    worst = float('inf')
+                continue
+
+            offset = max(abs(a - b) for a, b in zip(reference_box, other_box))
+            worst = max(worst, offset)
+            if offset > tolerance:
+                mismatched += 1
+    return compared, mismatched, worst
+
+def folder_size_mb(folder):
+    return sum(entry.stat().st_size for entry in os.scandir(folder) if entry.is_file()) / (1024 * 1024)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the PDF engines on a synthetic batch")
+    parser.add_argument("--people", type=int, default=8)
+    parser.add_argument("--sheets", type=int, default=4, help="Drawing sheets per layout PDF")
+    parser.add_argument("--photos", type=int, default=3, help="Photos per person")
+    parser.add_argument("--fit", action="store_true", help="Benchmark the --fit landscape conversion")
+    parser.add_argument("--optimise", action="store_true", help="Benchmark with --optimise output")
+    parser.add_argument("--engines", default=None, help="Comma separated (default: every installed engine)")
+    parser.add_argument("--workdir", default=None, help="Keep the batch and outputs here instead of a temp folder")
+    parser.add_argument("--timeout", type=float, default=1800, help="Seconds to wait for one engine before giving up on it")
+    args = parser.parse_args()
+
+    engine_names = args.engines.split(',') if args.engines else [name for name in ENGINE_NAMES if name != 'auto']
+    if 'pymupdf' in engine_names and not pymupdf_available():
+        print("PyMuPDF is not installed, skipping the pymupdf engine")
+        engine_names.remove('pymupdf')
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="engine-benchmark-")
+    os.makedirs(workdir, exist_ok=True)
+    batch_folder = os.path.join(workdir, "batch")
+    stamp_path = os.path.join(workdir, "stamp.png")
+
+    print(f"Building synthetic batch in {batch_folder}: {args.people} people x {args.sheets} sheets + {args.photos} photos")
+    make_stamp(stamp_path)
+    jobs = make_synthetic_batch(batch_folder, args.people, args.sheets, args.photos)
+
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    failed = {}  # engine -> why its child didn't report
+    for engine_name in engine_names:
+        output_folder = os.path.join(workdir, f"out-{engine_name}")
+        queue = context.Queue()
+        worker = context.Process(target=run_engine, args=(engine_name, jobs, stamp_path, output_folder,
+                                                          args.fit, args.optimise, queue))
+        worker.start()
+
+        # A child killed by the OOM killer or a crash in a native library never reports back
+        outcome = None
+        deadline = time.monotonic() + args.timeout
+        while outcome is None and time.monotonic() < deadline:
+            try:
+                outcome = queue.get(timeout=1)
+            except Empty:
+                if not worker.is_alive():
+                    break
+        if outcome is None:
+            if worker.is_alive():
+                worker.terminate()
+                failed[engine_name] = f"timed out after {args.timeout:.0f}s"
+            else:
+                failed[engine_name] = f"worker exited with code {worker.exitcode}"
+            worker.join()
+            print(f"{engine_name} failed: {failed[engine_name]}")
+            continue
+        worker.join()
+
+        seconds, peak = outcome
+        results[engine_name] = (seconds, peak, folder_size_mb(output_folder), output_folder)
+
+    if not results:
+        print("\nNo engine finished")
+        return
+    reference = next(iter(results))
+    sheets_total = args.people * args.sheets
+    print(f"\n{'engine':<10}{'seconds':>9}{'sheets/s':>10}{'peak MB':>9}{'output MB':>11}  stamp placement vs {reference}")
+    for engine_name, (seconds, peak, size, output_folder) in results.items():
+        if engine_name == reference:
+            parity = "reference"
+        else:
+            compared, mismatched, worst = compare_stamps(results[reference][3], output_folder, jobs, args.sheets)
+            parity = f"{compared - mismatched}/{compared} sheets match (max offset {worst:.1f} pt)"
+        peak_text = f"{peak:.0f}" if peak is not None else "n/a"
+        print(f"{engine_name:<10}{seconds:>9.2f}{sheets_total / seconds:>10.1f}{peak_text:>9}{size:>11.2f}  {parity}")
+    for engine_name, reason in failed.items():
+        print(f"{engine_name:<10}{'failed':>9}{'':>10}{'':>9}{'':>11}  {reason}")
+
+if __name__ == "__main__":
+    main()
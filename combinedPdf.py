@@ -0,0 +1,192 @@
+import hashlib
+from io import BytesIO
+from PyPDF2.generic import (ArrayObject, DecodedStreamObject, DictionaryObject, EncodedStreamObject, IndirectObject,
+                            NameObject, NumberObject, StreamObject, create_string_object)
+
+# Streams one combined PDF for a whole batch, with an outline entry per person.
+# Each person's pages are copied to disk as soon as they are added, so only
+# object offsets and content hashes stay in memory, never the document. Objects
+# are written once per unique content: the stamp image, fonts and other
+# resources repeated across people are stored a single time and shared.
+
+CATALOG_ID = 1
+PAGES_ID = 2
+OUTLINES_ID = 3
+INFO_ID = 4
+
+class CombinedPdfWriter:
+    def __init__(self, output_pdf_path):
+        self.output_pdf_path = output_pdf_path
+        self.stream = open(output_pdf_path, 'wb')
+        self.stream.write(b"%PDF-1.7\n%\xE2\xE3\xCF\xD3\n")
+
+        self.offsets = {}      # object number -> byte offset in the file
+        self.next_id = INFO_ID + 1
+        self.page_ids = []
+        self.outline = []      # (title, object number of the person's first page)
+        self.by_digest = {}    # content hash -> object number, for de-duplication
+        self.reused_objects = 0
+
+        # Per-document state used while copying one person's object graph
+        self.copied = {}
+        self.in_progress = set()
+        self.reserved = {}
+
+    def allocate_id(self):
+        object_id = self.next_id
+        self.next_id += 1
+        return object_id
+
+    def write_object(self, object_id, data):
+        self.offsets[object_id] = self.stream.tell()
+        self.stream.write(f"{object_id} 0 obj\n".encode())
+        self.stream.write(data)
+        self.stream.write(b"\nendobj\n")
+
+    # Convert an object from the source document, copying everything it refers to
+    def convert(self, obj, is_page=False):
+        if isinstance(obj, IndirectObject):
+            return IndirectObject(self.copy_indirect(obj), 0, None)
+
+        skipped_keys = {'/Parent'} if is_page else set()
+        if isinstance(obj, EncodedStreamObject):
+            converted = EncodedStreamObject()
+            converted._data = obj._data
+        elif isinstance(obj, StreamObject):
+            # Decoded streams (including parsed ContentStreams) are written out uncompressed
+            converted = DecodedStreamObject()
+            converted._data = obj.get_data()
+            skipped_keys = {'/Filter', '/DecodeParms'}
+        elif isinstance(obj, DictionaryObject):
+            converted = DictionaryObject()
+        elif isinstance(obj, ArrayObject):
+            return ArrayObject(self.convert(value) for value in obj)
+        else:
+            return obj
+
+        for key, value in obj.items():
+            if key in skipped_keys:
+                continue
+            converted[NameObject(key)] = self.convert(value)
+        if is_page:
+            converted[NameObject('/Parent')] = IndirectObject(PAGES_ID, 0, None)
+        return converted
+
+    # Copy one referenced object (after its children) and return its new object number
+    def copy_indirect(self, reference):
+        key = (id(reference.pdf), reference.idnum)
+        if key in self.copied:
+            return self.copied[key]
+        if key in self.in_progress:
+            # Reference cycle: give the object a number now and write it when it completes
+            return self.reserved.setdefault(key, self.allocate_id())
+
+        obj = reference.get_object()
+        is_page = isinstance(obj, DictionaryObject) and obj.get('/Type') == '/Page'
+
+        self.in_progress.add(key)
+        converted = self.convert(obj, is_page)
+        self.in_progress.discard(key)
+
+        buffer = BytesIO()
+        converted.write_to_stream(buffer, None)
+        data = buffer.getvalue()
+
+        if key in self.reserved:
+            object_id = self.reserved.pop(key)
+            self.write_object(object_id, data)
+        elif is_page:
+            object_id = self.allocate_id()
+            self.write_object(object_id, data)
+        else:
+            digest = hashlib.sha1(data).digest()
+            object_id = self.by_digest.get(digest)
+            if object_id is None:
+                object_id = self.allocate_id()
+                self.by_digest[digest] = object_id
+                self.write_object(object_id, data)
+            else:
+                self.reused_objects += 1
+
+        self.copied[key] = object_id
+        return object_id
+
+    # Append a document's pages (e.g. PdfWriter.pages) under one outline entry
+    def add_document(self, pages, title):
+        self.copied = {}
+        self.in_progress = set()
+        self.reserved = {}
+
+        first_page_id = None
+        for page in pages:
+            page_id = self.copy_indirect(page.indirect_reference)
+            self.page_ids.append(page_id)
+            if first_page_id is None:
+                first_page_id = page_id
+
+        if first_page_id is not None:
+            self.outline.append((title, first_page_id))
+
+    def write_outline(self):
+        item_ids = [self.allocate_id() for _ in self.outline]
+
+        for index, (title, page_id) in enumerate(self.outline):
+            item = DictionaryObject()
+            item[NameObject('/Title')] = create_string_object(title)
+            item[NameObject('/Parent')] = IndirectObject(OUTLINES_ID, 0, None)
+            item[NameObject('/Dest')] = ArrayObject([IndirectObject(page_id, 0, None), NameObject('/Fit')])
+            if index > 0:
+                item[NameObject('/Prev')] = IndirectObject(item_ids[index - 1], 0, None)
+            if index < len(item_ids) - 1:
+                item[NameObject('/Next')] = IndirectObject(item_ids[index + 1], 0, None)
+            self.write_dictionary(item_ids[index], item)
+
+        outlines = DictionaryObject()
+        outlines[NameObject('/Type')] = NameObject('/Outlines')
+        outlines[NameObject('/Count')] = NumberObject(len(item_ids))
+        if item_ids:
+            outlines[NameObject('/First')] = IndirectObject(item_ids[0], 0, None)
+            outlines[NameObject('/Last')] = IndirectObject(item_ids[-1], 0, None)
+        self.write_dictionary(OUTLINES_ID, outlines)
+
+    def write_dictionary(self, object_id, dictionary):
+        buffer = BytesIO()
+        dictionary.write_to_stream(buffer, None)
+        self.write_object(object_id, buffer.getvalue())
+
+    # Write the page tree, outline, catalog, xref table and trailer, then close the file
+    def close(self):
+        pages = DictionaryObject()
+        pages[NameObject('/Type')] = NameObject('/Pages')
+        pages[NameObject('/Count')] = NumberObject(len(self.page_ids))
+        pages[NameObject('/Kids')] = ArrayObject(IndirectObject(page_id, 0, None) for page_id in self.page_ids)
+        self.write_dictionary(PAGES_ID, pages)
+
+        self.write_outline()
+
+        catalog = DictionaryObject()
+        catalog[NameObject('/Type')] = NameObject('/Catalog')
+        catalog[NameObject('/Pages')] = IndirectObject(PAGES_ID, 0, None)
+        catalog[NameObject('/Outlines')] = IndirectObject(OUTLINES_ID, 0, None)
+        catalog[NameObject('/PageMode')] = NameObject('/UseOutlines')
+        self.write_dictionary(CATALOG_ID, catalog)
+
+        info = DictionaryObject()
+        info[NameObject('/Producer')] = create_string_object('endorsementAutomation')
+        self.write_dictionary(INFO_ID, info)
+
+        xref_location = self.stream.tell()
+        self.stream.write(f"xref\n0 {self.next_id}\n".encode())
+        self.stream.write(b"0000000000 65535 f \n")
+        for object_id in range(1, self.next_id):
+            if object_id in self.offsets:
+                self.stream.write(f"{self.offsets[object_id]:010d} 00000 n \n".encode())
+            else:
+                self.stream.write(b"0000000000 65535 f \n")
+
+        self.stream.write(f"trailer\n<< /Size {self.next_id} /Root {CATALOG_ID} 0 R /Info {INFO_ID} 0 R >>\n".encode())
+        self.stream.write(f"startxref\n{xref_location}\n%%EOF\n".encode())
+        self.stream.close()
+
+        print(f"Combined PDF written to {self.output_pdf_path}: {len(self.outline)} people, "
+              f"{len(self.page_ids)} pages, {self.reused_objects} repeated objects shared")
@@ -1,35 +1,48 @@
 import os
-import pandas as pd
-import re
-
-# Load the Excel file (this would be replaced by the actual file path)
-file_path = r'C:\Users\yewyn\Documents\Verdant\BATCH 71.xlsx'
-excel_data = pd.read_excel(file_path)
-
-# Define the output directory where you want to create the folders
-output_directory = r'C:\Users\yewyn\Documents\Verdant\Batch 71'  # You can change this path
-
-# Ensure the output directory exists
-if not os.path.exists(output_directory):
-    os.makedirs(output_directory)
-
-# Function to sanitize folder names
-def sanitize_folder_name(name):
-    # Replace slashes, tabs, and other problematic characters with underscores
-    sanitized_name = re.sub(r'[<>:"/\\|?*\t\n\r]', '_', name)
-    return sanitized_name.strip()
-
-# Loop through the Excel data and create directories
-for index, row in excel_data.iterrows():
-    sanitized_name = sanitize_folder_name(row['Name'])
-    folder_name = f"{index + 1}_{sanitized_name}"  # Create folder name with index and sanitized name
-    folder_path = os.path.join(output_directory, folder_name)  # Full path of the folder
-    
-    # Create the directory
-    if not os.path.exists(folder_path):
-        os.makedirs(folder_path)
+import argparse
+from downloadPDF import person_folder_name
+
+# Function to list the folder names already present in the output directory
+# (a single directory scan instead of an exists() check per row)
+def existing_folder_names(output_directory):
+    with os.scandir(output_directory) as entries:
+        return {entry.name for entry in entries if entry.is_dir()}
+
+# Function to create the person folders for a batch, using the same naming
+# rule as the downloaders so they write into these folders
+def create_endorsement_directories(excel_path, output_directory):
+    import pandas as pd
+
+    # Load the Excel file
+    excel_data = pd.read_excel(excel_path)
+
+    # Ensure the output directory exists
+    os.makedirs(output_directory, exist_ok=True)
+
+    # Compared with normcase so "1_Ann" and "1_ANN" are the same folder where the
+    # file system says so (Windows), but not where it doesn't
+    existing = {os.path.normcase(folder_name) for folder_name in existing_folder_names(output_directory)}
+    wanted = list(dict.fromkeys(person_folder_name(no, name) for no, name in zip(excel_data['No'], excel_data['Name'])))
+    missing = [folder_name for folder_name in wanted if os.path.normcase(folder_name) not in existing]
+
+    # Create only the folders that aren't there yet
+    created = []
+    for folder_name in missing:
+        try:
+            os.mkdir(os.path.join(output_directory, folder_name))
+        except FileExistsError:
+            # Created meanwhile, or differs only in case on a case-insensitive file system (e.g. a macOS share)
+            continue
+        created.append(folder_name)
         print(f"Created folder: {folder_name}")
 
-print(f"All folders created in {output_directory}")
+    print(f"All folders created in {output_directory} ({len(created)} new, {len(wanted) - len(created)} already present)")
+    return created
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create one folder per person listed in a batch spreadsheet")
+    parser.add_argument("excel_path", help="Batch spreadsheet (No, Name columns)")
+    parser.add_argument("output_directory", help="Folder to create the person folders in")
+    args = parser.parse_args()
 
+    create_endorsement_directories(args.excel_path, args.output_directory)
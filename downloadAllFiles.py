@@ -1,36 +1,13 @@
+import math
 import os
 import re
-import pandas as pd
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-import pickle
 import requests
-
-def authenticate_gdrive():
-    SCOPES = ['https://www.googleapis.com/auth/drive']
-    creds = None
-
-    # Token file stores the user's access and refresh tokens
-    if os.path.exists('token.pickle'):
-        with open('token.pickle', 'rb') as token:
-            creds = pickle.load(token)
-
-    # If there are no valid credentials, ask the user to log in
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
-            creds = flow.run_local_server(port=0)
-
-        # Save the credentials for the next run
-        with open('token.pickle', 'wb') as token:
-            pickle.dump(creds, token)
-
-    service = build('drive', 'v3', credentials=creds)
-    return service
+from driveService import authenticate_gdrive, authorization_headers
+from downloadPDF import person_folder_name
+from downloadUtils import (SharedDownloads, download_key, count_unique, VerifyingWriter, DownloadVerificationError,
+                           stream_response_to_file)
+from shardWork import add_shard_arguments, sharding_from_args
+from downloadTelemetry import telemetry, host_of, add_telemetry_arguments, configure_from_args
 
 # Function to extract Google Drive ID and type
 def extract_id(link):
@@ -66,54 +43,176 @@ def is_image_file(file_name, mime_type=None):
     
     return False
 
-# Function to download PDF files directly
-def download_pdf(pdf_url, folder_path):
-    try:
-        response = requests.get(pdf_url)
-        response.raise_for_status()
-
-        file_name = pdf_url.split("/")[-1]
-        file_path = os.path.join(folder_path, file_name)
-
-        os.makedirs(folder_path, exist_ok=True)
-
-        with open(file_path, 'wb') as pdf_file:
-            pdf_file.write(response.content)
-        
-        print(f"Downloaded PDF: {file_path}")
-
-    except Exception as e:
-        print(f"Failed to download PDF from {pdf_url}: {e}")
+# Function to download PDF files directly (returns the file path, or None on failure)
+# The bytes are verified while they stream to disk (size and PDF magic bytes) and
+# bad downloads are retried, the same way as downloadPDF.download_pdf.
+def download_pdf(pdf_url, folder_path, max_retries=3):
+    file_name = pdf_url.split("/")[-1]
+    file_path = os.path.join(folder_path, file_name)
+    os.makedirs(folder_path, exist_ok=True)
+
+    for attempt in range(max_retries):
+        try:
+            with telemetry.request('http_pdf', pdf_url, host_of(pdf_url)) as event:
+                response = requests.get(pdf_url, timeout=30, stream=True)
+                response.raise_for_status()
+
+                # Content-Length is only the file size when the body isn't compressed
+                expected_size = None
+                if 'content-encoding' not in response.headers:
+                    expected_size = response.headers.get('content-length')
+
+                event.bytes = stream_response_to_file(response, file_path, expected_size=expected_size)
+
+            print(f"Downloaded PDF: {file_path}")
+            return file_path
+
+        except (DownloadVerificationError, requests.exceptions.Timeout) as e:
+            if attempt < max_retries - 1:
+                telemetry.retry('http_pdf', e, pdf_url)
+                print(f"Rejected download of {pdf_url} ({e}), retrying...")
+                continue
+            print(f"Failed to download PDF from {pdf_url} after {max_retries} attempts: {e}")
+            return None
+
+        except Exception as e:
+            print(f"Failed to download PDF from {pdf_url}: {e}")
+            return None
 
 # Function to download file from Google Drive (simplified output)
-def download_file_from_gdrive(service, file_id, file_name, folder_path):
-    try:
-        request = service.files().get_media(fileId=file_id)
-        file_path = os.path.join(folder_path, file_name)
-
-        os.makedirs(folder_path, exist_ok=True)
+# The bytes are verified while they stream to disk (MD5/size from Drive when
+# known, plus the file type's magic bytes) and bad downloads are retried.
+def download_file_from_gdrive(service, file_id, file_name, folder_path, expected_md5=None, expected_size=None, max_retries=3):
+    from googleapiclient.http import MediaIoBaseDownload
+
+    file_path = os.path.join(folder_path, file_name)
+    part_path = file_path + '.part'
+    os.makedirs(folder_path, exist_ok=True)
+
+    for attempt in range(max_retries):
+        try:
+            with telemetry.request('drive_media', file_id) as event:
+                request = service.files().get_media(fileId=file_id)
+
+                with open(part_path, 'wb') as fh:
+                    writer = VerifyingWriter(fh)
+                    downloader = MediaIoBaseDownload(writer, request)
+                    done = False
+                    while not done:
+                        status, done = downloader.next_chunk()
+                event.bytes = writer.size
+
+                writer.verify(file_name, expected_md5, expected_size)
+            os.replace(part_path, file_path)
+
+            # Only print when download is complete
+            return file_path
+
+        except Exception as e:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            if isinstance(e, DownloadVerificationError) and attempt < max_retries - 1:
+                telemetry.retry('drive_media', e, file_id)
+                print(f"Rejected download of {file_name} ({e}), retrying...")
+                continue
+            raise Exception(f"Failed to download {file_name}: {e}")
+
+# Photos only ever fill a landscape A4 page (297mm wide), so at a given page DPI
+# this is the longest edge in pixels that is worth downloading
+def photo_size_for_dpi(dpi):
+    return math.ceil(297 / 25.4 * dpi)
+
+# Drive thumbnail links end in a size such as "=s220"; ask for size pixels on the longest edge instead
+def sized_thumbnail_link(thumbnail_link, size):
+    if re.search(r'=s\d+[^/=]*$', thumbnail_link):
+        return re.sub(r'=s\d+[^/=]*$', f'=s{size}', thumbnail_link)
+    return f"{thumbnail_link}=s{size}"
+
+THUMBNAIL_EXTENSIONS = {'image/jpeg': '.jpg', 'image/png': '.png'}
+
+# Function to download a resized copy of a Drive photo through its thumbnail link.
+# Returns the file path, or None when the original should be downloaded instead
+# (no thumbnail, original no bigger than needed, or Drive returned a smaller image)
+def download_reduced_image(item, folder_path, photo_size):
+    from PIL import Image
+
+    file_id = item['id']
+    thumbnail_link = item.get('thumbnailLink')
+    metadata = item.get('imageMediaMetadata') or {}
+    original_size = max(metadata.get('width', 0), metadata.get('height', 0))
+    if not thumbnail_link or (original_size and original_size <= photo_size):
+        return None
 
-        with open(file_path, 'wb') as fh:
-            downloader = MediaIoBaseDownload(fh, request)
-            done = False
-            while not done:
-                status, done = downloader.next_chunk()
-        
-        # Only print when download is complete
-        return True
+    try:
+        url = sized_thumbnail_link(thumbnail_link, photo_size)
+        with telemetry.request('drive_thumbnail', file_id, host_of(url)) as event:
+            response = requests.get(url, headers=authorization_headers(), timeout=30, stream=True)
+            if response.status_code != 200:
+                event.fail(response.status_code)
+                return None
+
+            content_type = response.headers.get('content-type', '').split(';')[0]
+            extension = THUMBNAIL_EXTENSIONS.get(content_type)
+            if extension is None:
+                event.fail('unsupported_type')
+                return None
+
+            os.makedirs(folder_path, exist_ok=True)
+            file_path = os.path.join(folder_path, os.path.splitext(item['name'])[0] + extension)
+            event.bytes = stream_response_to_file(response, file_path)
+
+            # Drive caps thumbnail sizes; if it sent much less than asked for, use the original
+            with Image.open(file_path) as image:
+                received_size = max(image.size)
+            if received_size < 0.9 * min(photo_size, original_size or photo_size):
+                os.remove(file_path)
+                event.fail('too_small')
+                print(f"Thumbnail for {item['name']} is only {received_size}px, downloading the original")
+                return None
+        return file_path
 
     except Exception as e:
-        raise Exception(f"Failed to download {file_name}: {e}")
-
-def download_images_in_folder(service, folder_id, folder_path, person_name="Unknown"):
+        print(f"Reduced download of {item['name']} failed ({e}), downloading the original")
+        return None
+
+# Function to download one Drive photo: resized to photo_size pixels on the
+# longest edge when given (and possible), otherwise the full-resolution original
+def download_photo(service, item, folder_path, photo_size=None):
+    if photo_size:
+        file_path = download_reduced_image(item, folder_path, photo_size)
+        if file_path:
+            return file_path
+    return download_file_from_gdrive(service, item['id'], item['name'], folder_path,
+                                     item.get('md5Checksum'), item.get('size'))
+
+# Function to add the photo resolution options to a script's argparse parser
+def add_photo_size_arguments(parser):
+    parser.add_argument("--photo-dpi", type=int, default=150,
+                        help="Fetch photos resized for a landscape A4 page at this DPI (default 150)")
+    parser.add_argument("--full-resolution", action="store_true",
+                        help="Archive mode: always download the original full-resolution photos")
+
+# Longest photo edge in pixels for those options, or None for originals
+def photo_size_from_args(args):
+    if args.full_resolution or not args.photo_dpi:
+        return None
+    return photo_size_for_dpi(args.photo_dpi)
+
+# Fields download_photo uses, for files().list / files().get
+PHOTO_FIELDS = "id, name, mimeType, size, md5Checksum, thumbnailLink, imageMediaMetadata(width, height)"
+
+# Downloaded file paths are appended to downloaded_files when a list is given.
+# photo_size (pixels, longest edge) fetches reduced copies; None keeps full resolution.
+def download_images_in_folder(service, folder_id, folder_path, person_name="Unknown", downloaded_files=None, photo_size=None):
     try:
         query = f"'{folder_id}' in parents"
-        results = service.files().list(
-            q=query,
-            fields="files(id, name, mimeType, size)",
-            supportsAllDrives=True,
-            includeItemsFromAllDrives=True
-        ).execute()
+        with telemetry.request('drive_list', folder_id):
+            results = service.files().list(
+                q=query,
+                fields=f"files({PHOTO_FIELDS})",
+                supportsAllDrives=True,
+                includeItemsFromAllDrives=True
+            ).execute()
 
         items = results.get('files', [])
 
@@ -124,13 +223,14 @@ def download_images_in_folder(service, folder_id, folder_path, person_name="Unkn
         
         for item in items:
             file_name = item['name']
-            file_id = item['id']
             mime_type = item.get('mimeType', '')
 
             try:
                 if is_image_file(file_name, mime_type):
-                    download_file_from_gdrive(service, file_id, file_name, folder_path)
+                    file_path = download_photo(service, item, folder_path, photo_size)
                     successful_downloads += 1
+                    if downloaded_files is not None:
+                        downloaded_files.append(file_path)
                 else:
                     print(f"Skipping non-image file (trying fallback): {file_name} (MIME: {mime_type})")
                     # Fallback: attempt to download anyway
@@ -145,6 +245,50 @@ def download_images_in_folder(service, folder_id, folder_path, person_name="Unkn
         return 0, [(person_name, "Folder access failed", str(e))]
 
 
+# Function to download one row's Drive photos (a single file or a folder) into person_folder
+# Returns (successful downloads, failed downloads)
+def download_images_for_row(service, gdrive_id, gdrive_type, gdrive_key, person_name, person_folder, shared, photo_size=None):
+    successful = 0
+    failed = []
+
+    with shared.key_lock(gdrive_key):
+        if shared.lookup(gdrive_key) is not None:
+            # Another row already downloaded this Drive file/folder
+            linked = shared.materialise(gdrive_key, person_folder)
+            print(f"Processing folder for {person_name}: reused {len(linked)} images already downloaded")
+            successful += len(linked)
+
+        elif gdrive_type == "file":
+            # Check if the single file is an image before downloading
+            try:
+                with telemetry.request('drive_metadata', gdrive_id):
+                    file_metadata = service.files().get(fileId=gdrive_id, fields=PHOTO_FIELDS).execute()
+                file_name = file_metadata['name']
+                mime_type = file_metadata.get('mimeType', '')
+
+                if is_image_file(file_name, mime_type):
+                    print(f"Processing folder for {person_name}: 1 images found")
+                    try:
+                        file_path = download_photo(service, file_metadata, person_folder, photo_size)
+                        successful += 1
+                        shared.remember(gdrive_key, [file_path])
+                    except Exception as e:
+                        failed.append((person_name, file_name, str(e)))
+                else:
+                    print(f"Processing folder for {person_name}: 0 images found (file is not an image)")
+            except Exception as e:
+                failed.append((person_name, "Error checking file", str(e)))
+
+        elif gdrive_type == "folder":
+            downloaded_files = []
+            successful, failed = download_images_in_folder(service, gdrive_id, person_folder, person_name, downloaded_files,
+                                                           photo_size)
+            # Only share complete folders so later rows retry anything that failed
+            if not failed:
+                shared.remember(gdrive_key, downloaded_files)
+
+    return successful, failed
+
 # Alternative function that downloads images recursively from subfolders too
 def download_images_recursively(service, folder_id, folder_path, max_depth=3, current_depth=0):
     if current_depth > max_depth:
@@ -153,12 +297,13 @@ def download_images_recursively(service, folder_id, folder_path, max_depth=3, cu
     
     try:
         query = f"'{folder_id}' in parents"
-        results = service.files().list(
-            q=query,
-            fields="files(id, name, mimeType, size)",
-            supportsAllDrives=True,
-            includeItemsFromAllDrives=True
-        ).execute()
+        with telemetry.request('drive_list', folder_id):
+            results = service.files().list(
+                q=query,
+                fields="files(id, name, mimeType, size)",
+                supportsAllDrives=True,
+                includeItemsFromAllDrives=True
+            ).execute()
 
         items = results.get('files', [])
         
@@ -189,7 +334,9 @@ def download_images_recursively(service, folder_id, folder_path, max_depth=3, cu
     except Exception as e:
         print(f"Error while accessing folder {folder_id}: {e}")
 
-def main():
+def main(args=None):
+    import pandas as pd
+
     # Load your Excel file
     df = pd.read_excel(r'C:\Users\yewyn\Documents\Verdant\BATCH 86.xlsx')
 
@@ -205,48 +352,88 @@ def main():
     all_failed_downloads = []
     processed_entries = 0
 
+    photo_size = photo_size_from_args(args) if args else None
+    if photo_size:
+        print(f"Downloading photos at up to {photo_size}px on the longest edge (--full-resolution for originals)")
+
+    # Plan the batch first so Drive folders/files and layout PDFs shared by
+    # several rows are fetched only once
+    plan = []
     for index, row in df.iterrows():
         gdrive_link = row['G.Drive Link']
-        drawing_link = row['Layout Link']
+        # Blank cells come back from pandas as NaN; treat them as "no layout PDF"
+        drawing_link = row['Layout Link'] if isinstance(row['Layout Link'], str) else None
         person_name = row['Name']
 
         # Handle Google Drive links
-        gdrive_id, gdrive_type = extract_id(gdrive_link)
-        
+        gdrive_id, gdrive_type = extract_id(gdrive_link) if isinstance(gdrive_link, str) else (None, None)
+        plan.append((gdrive_link, gdrive_id, gdrive_type, drawing_link, person_name, row['No']))
+
+    plan_keys = [download_key(gdrive_link, gdrive_id) for gdrive_link, gdrive_id, _, _, _, _ in plan if gdrive_id]
+    plan_keys += [download_key(drawing_link) for _, gdrive_id, _, drawing_link, _, _ in plan
+                  if gdrive_id and drawing_link and drawing_link.endswith('.pdf')]
+    link_count, unique_count = count_unique(plan_keys)
+    print(f"Planned {link_count} links, {unique_count} unique Drive objects/PDFs to download\n")
+
+    shared = SharedDownloads()
+
+    # When several machines share the batch folder, only download this node's rows
+    work = plan
+    sharding = sharding_from_args(args, base_download_path, 'photos') if args else None
+    if sharding:
+        work = sharding.select([(person_folder_name(entry[5], entry[4]), entry[5], entry) for entry in plan])
+
+    # Sync mode: bring every row's photos up to date with Drive in one pass
+    syncer = None
+    if args and args.sync:
+        from driveSync import DriveSync
+
+        syncer = DriveSync(service, base_download_path, photo_size, args.sync_mode)
+        sync_rows = [(os.path.join(base_download_path, person_folder_name(row_no, person_name)), gdrive_id, gdrive_type)
+                     for _, gdrive_id, gdrive_type, _, person_name, row_no in plan if gdrive_id]
+        downloaded, _, sync_failed = syncer.sync(sync_rows)
+        total_successful += downloaded
+        all_failed_downloads.extend(sync_failed)
+
+    for gdrive_link, gdrive_id, gdrive_type, drawing_link, person_name, row_no in work:
         if gdrive_id is None:
             all_failed_downloads.append((person_name, "Invalid Google Drive link", gdrive_link))
+            if sharding:
+                sharding.release(person_folder_name(row_no, person_name), 'failed', error="Invalid Google Drive link")
             continue
         
-        person_folder = os.path.join(base_download_path, person_name)
+        # Same folder naming as the other download scripts ("<No>_<Name>")
+        person_folder = os.path.join(base_download_path, person_folder_name(row_no, person_name))
         processed_entries += 1
+        gdrive_key = download_key(gdrive_link, gdrive_id)
 
-        if gdrive_type == "file":
-            # Check if the single file is an image before downloading
-            try:
-                file_metadata = service.files().get(fileId=gdrive_id, fields='name,mimeType').execute()
-                file_name = file_metadata['name']
-                mime_type = file_metadata.get('mimeType', '')
-                
-                if is_image_file(file_name, mime_type):
-                    print(f"Processing folder for {person_name}: 1 images found")
-                    try:
-                        download_file_from_gdrive(service, gdrive_id, file_name, person_folder)
-                        total_successful += 1
-                    except Exception as e:
-                        all_failed_downloads.append((person_name, file_name, str(e)))
-                else:
-                    print(f"Processing folder for {person_name}: 0 images found (file is not an image)")
-            except Exception as e:
-                all_failed_downloads.append((person_name, "Error checking file", str(e)))
-                
-        elif gdrive_type == "folder":
-            successful, failed = download_images_in_folder(service, gdrive_id, person_folder, person_name)
+        failed = []
+        if syncer is None:
+            successful, failed = download_images_for_row(service, gdrive_id, gdrive_type, gdrive_key,
+                                                         person_name, person_folder, shared, photo_size)
             total_successful += successful
             all_failed_downloads.extend(failed)
-        
-        # Handle PDF downloads (keep existing functionality)
-        if drawing_link and drawing_link.endswith('.pdf'):
-            download_pdf(drawing_link, person_folder)
+
+        # Handle PDF downloads (keep existing functionality); a sync only fetches missing ones
+        pdf_present = syncer is not None and drawing_link and os.path.exists(os.path.join(person_folder, drawing_link.split("/")[-1]))
+        if drawing_link and drawing_link.endswith('.pdf') and not pdf_present:
+            pdf_key = download_key(drawing_link)
+            with shared.key_lock(pdf_key):
+                if shared.lookup(pdf_key) is not None:
+                    shared.materialise(pdf_key, person_folder)
+                else:
+                    file_path = download_pdf(drawing_link, person_folder)
+                    if file_path:
+                        shared.remember(pdf_key, [file_path])
+                    else:
+                        # Counted as a failure so the row isn't marked done and another run retries it
+                        pdf_failure = (person_name, drawing_link.split("/")[-1], f"Failed to download layout PDF {drawing_link}")
+                        failed.append(pdf_failure)
+                        all_failed_downloads.append(pdf_failure)
+
+        if sharding:
+            sharding.release(os.path.basename(person_folder), 'failed' if failed else 'ok', person_folder,
+                             '; '.join(str(error) for _, _, error in failed))
 
     # Print final summary
     print(f"\n" + "="*60)
@@ -255,6 +442,9 @@ def main():
     print(f"Total entries processed: {processed_entries}")
     print(f"Total images successfully downloaded: {total_successful}")
     print(f"Total failed downloads: {len(all_failed_downloads)}")
+    print(shared.summary())
+    if sharding:
+        sharding.write_summary([person_folder_name(row_no, person_name) for _, _, _, _, person_name, row_no in plan])
     
     if all_failed_downloads:
         print(f"\nFAILED DOWNLOADS ({len(all_failed_downloads)}):")
@@ -268,4 +458,20 @@ def main():
         print("\n✅ All downloads were successful!")
 
 if __name__ == "__main__":
-    main()
+    import argparse
+    from driveSync import add_sync_arguments
+
+    parser = argparse.ArgumentParser(description="Download the site photos (and layout PDFs) for every row of the batch spreadsheet")
+    add_shard_arguments(parser)
+    add_telemetry_arguments(parser)
+    add_photo_size_arguments(parser)
+    add_sync_arguments(parser)
+    args = parser.parse_args()
+    if args.sync and (args.shard or args.claim):
+        parser.error("--sync keeps one state file per batch and cannot be combined with --shard/--claim")
+
+    configure_from_args(args)
+    try:
+        main(args)
+    finally:
+        telemetry.close()
@@ -1,13 +1,11 @@
 import os
 import re
-import pandas as pd
 import requests
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from googleapiclient.errors import HttpError
-import pickle
 import time
+from driveService import authenticate_gdrive
+from downloadUtils import SharedDownloads, download_key, count_unique, stream_response_to_file, DownloadVerificationError
+from shardWork import add_shard_arguments, sharding_from_args
+from downloadTelemetry import telemetry, host_of, add_telemetry_arguments, configure_from_args
 
 # Function to extract Google Drive file ID
 def extract_drive_id(link):
@@ -30,34 +28,12 @@ def extract_drive_id(link):
     
     return None
 
-# Function to authenticate with Google Drive
-def authenticate_gdrive():
-    SCOPES = ['https://www.googleapis.com/auth/drive']  # Full access instead of readonly
-    creds = None
-
-    # Token file stores the user's access and refresh tokens
-    if os.path.exists('token.pickle'):
-        with open('token.pickle', 'rb') as token:
-            creds = pickle.load(token)
-
-    # If there are no valid credentials, ask the user to log in
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
-            creds = flow.run_local_server(port=0)
-
-        # Save the credentials for the next run
-        with open('token.pickle', 'wb') as token:
-            pickle.dump(creds, token)
-
-    service = build('drive', 'v3', credentials=creds)
-    return service
-
 def check_gdrive_file_exists(service, file_id):
+    from googleapiclient.errors import HttpError
+
     try:
-        file_metadata = service.files().get(fileId=file_id, fields='name,permissions').execute()
+        with telemetry.request('drive_metadata', file_id):
+            file_metadata = service.files().get(fileId=file_id, fields='name,permissions').execute()
         return True, file_metadata['name']
     except HttpError as e:
         if e.resp.status == 404:
@@ -68,13 +44,21 @@ def check_gdrive_file_exists(service, file_id):
             return False, f"HTTP Error {e.resp.status}: {e._get_reason()}"
 
 # Function to download a Google Drive file using file ID
+# Returns (True, file_path) on success or (False, error message)
 def download_file_from_gdrive(service, file_id, folder_path, max_retries=3):
+    from googleapiclient.errors import HttpError
+
     file_name = None
+    expected_md5 = None
+    expected_size = None
     
-    # Try to get the original filename from API first
+    # Try to get the original filename (and checksum/size for verification) from API first
     try:
-        file_metadata = service.files().get(fileId=file_id, fields='name').execute()
+        with telemetry.request('drive_metadata', file_id):
+            file_metadata = service.files().get(fileId=file_id, fields='name,md5Checksum,size').execute()
         file_name = file_metadata['name']
+        expected_md5 = file_metadata.get('md5Checksum')
+        expected_size = file_metadata.get('size')
         print(f"Found original filename: {file_name}")
     except HttpError as e:
         if e.resp.status == 404:
@@ -86,61 +70,69 @@ def download_file_from_gdrive(service, file_id, folder_path, max_retries=3):
         print(f"API error for {file_id}: {str(e)}, continuing with direct download")
     
     # Attempt direct download
+    confirm = False
     for attempt in range(max_retries):
         try:
-            file_url = f"https://drive.google.com/uc?export=download&id={file_id}"
-            response = requests.get(file_url, timeout=30)
-            
-            # Handle Google Drive's redirect for large files
-            if response.status_code == 200:
-                # If we didn't get filename from API, try to extract from response headers
-                if not file_name:
-                    content_disposition = response.headers.get('content-disposition', '')
-                    if 'filename=' in content_disposition:
-                        # Extract filename from Content-Disposition header
-                        file_name = content_disposition.split('filename=')[1].strip('"\'')
-                    else:
-                        # Fallback to file_id with .pdf extension
-                        file_name = f"{file_id}.pdf"
-                
-                # Ensure the filename is safe for the filesystem
-                file_name = sanitize_filename(file_name)
-                file_path = os.path.join(folder_path, file_name)
-                
-                with open(file_path, 'wb') as drive_file:
-                    drive_file.write(response.content)
+            with telemetry.request('drive_direct', file_id, 'drive.google.com') as event:
+                file_url = f"https://drive.google.com/uc?export=download&id={file_id}"
+                if confirm:
+                    # Skip the virus-scan interstitial Drive serves for large files
+                    file_url += "&confirm=t"
+                response = requests.get(file_url, timeout=30, stream=True)
                 
-                print(f"Downloaded Google Drive file: {file_path}")
-                return True, None
-                
-            elif response.status_code == 303:
-                # Handle redirect - Google sometimes returns 303 for large files
-                print(f"Received redirect (303) for {file_id}, following redirect...")
-                redirect_url = response.headers.get('Location')
-                if redirect_url:
-                    redirect_response = requests.get(redirect_url, timeout=30)
-                    if redirect_response.status_code == 200:
-                        if not file_name:
+                # Handle Google Drive's redirect for large files
+                if response.status_code == 303:
+                    print(f"Received redirect (303) for {file_id}, following redirect...")
+                    redirect_url = response.headers.get('Location')
+                    if redirect_url:
+                        response = requests.get(redirect_url, timeout=30, stream=True)
+                event.host = host_of(response.url)
+
+                if response.status_code == 200:
+                    # If we didn't get filename from API, try to extract from response headers
+                    if not file_name:
+                        content_disposition = response.headers.get('content-disposition', '')
+                        if 'filename=' in content_disposition:
+                            # Extract filename from Content-Disposition header
+                            file_name = content_disposition.split('filename=')[1].strip('"\'')
+                        else:
+                            # Fallback to file_id with .pdf extension
                             file_name = f"{file_id}.pdf"
-                        file_name = sanitize_filename(file_name)
-                        file_path = os.path.join(folder_path, file_name)
-                        
-                        with open(file_path, 'wb') as drive_file:
-                            drive_file.write(redirect_response.content)
-                        
-                        print(f"Downloaded Google Drive file: {file_path}")
-                        return True, None
-            else:
-                error_msg = f"HTTP {response.status_code}: Could not download file"
-                if attempt < max_retries - 1:
-                    print(f"Download failed for {file_id}, retrying in 2 seconds...")
-                    time.sleep(2)
+                    
+                    # Ensure the filename is safe for the filesystem
+                    file_name = sanitize_filename(file_name)
+                    file_path = os.path.join(folder_path, file_name)
+                    
+                    # Verified while streaming; bad content raises DownloadVerificationError
+                    event.bytes = stream_response_to_file(response, file_path, expected_md5, expected_size)
+                    
+                    print(f"Downloaded Google Drive file: {file_path}")
+                    return True, file_path
                 else:
-                    return False, error_msg
+                    event.fail(response.status_code)
+                    error_msg = f"HTTP {response.status_code}: Could not download file"
+
+            # Only reached for a non-200 response
+            if attempt < max_retries - 1:
+                telemetry.retry('drive_direct', response.status_code, file_id)
+                print(f"Download failed for {file_id}, retrying in 2 seconds...")
+                time.sleep(2)
+            else:
+                return False, error_msg
                     
-        except requests.exceptions.Timeout:
+        except DownloadVerificationError as e:
+            error_msg = f"Verification failed: {e}"
+            confirm = confirm or e.is_html
+            if attempt < max_retries - 1:
+                telemetry.retry('drive_direct', e, file_id)
+                print(f"Rejected download of {file_id} ({e}), retrying...")
+            else:
+                return False, error_msg
+
+        except requests.exceptions.Timeout as e:
             error_msg = f"Timeout error (attempt {attempt + 1}/{max_retries})"
             if attempt < max_retries - 1:
+                telemetry.retry('drive_direct', e, file_id)
                 print(f"Timeout downloading {file_id}, retrying in 2 seconds...")
                 time.sleep(2)
             else:
@@ -149,6 +141,7 @@ def download_file_from_gdrive(service, file_id, folder_path, max_retries=3):
         except Exception as e:
             error_msg = f"Unexpected error: {str(e)}"
             if attempt < max_retries - 1:
+                telemetry.retry('drive_direct', e, file_id)
                 print(f"Error downloading {file_id}, retrying in 2 seconds...")
                 time.sleep(2)
             else:
@@ -169,28 +162,43 @@ def sanitize_filename(filename):
     return sanitized
 
 # Function to download PDF files directly from URL
+# Returns (True, file_path) on success or (False, error message)
 def download_pdf(pdf_url, folder_path, max_retries=3):
     for attempt in range(max_retries):
         try:
-            response = requests.get(pdf_url, timeout=30)
-            response.raise_for_status()
-
-            # Prepare the filename
-            file_name = pdf_url.split("/")[-1]
-            if not file_name.endswith('.pdf'):
-                file_name += '.pdf'
-            file_path = os.path.join(folder_path, file_name)
-
-            # Write the PDF to file
-            with open(file_path, 'wb') as pdf_file:
-                pdf_file.write(response.content)
+            with telemetry.request('http_pdf', pdf_url, host_of(pdf_url)) as event:
+                response = requests.get(pdf_url, timeout=30, stream=True)
+                response.raise_for_status()
+
+                # Prepare the filename
+                file_name = pdf_url.split("/")[-1]
+                if not file_name.endswith('.pdf'):
+                    file_name += '.pdf'
+                file_path = os.path.join(folder_path, file_name)
+
+                # Content-Length is only the file size when the body isn't compressed
+                expected_size = None
+                if 'content-encoding' not in response.headers:
+                    expected_size = response.headers.get('content-length')
+
+                # Write the PDF to file, verified while streaming
+                event.bytes = stream_response_to_file(response, file_path, expected_size=expected_size)
             
             print(f"Downloaded PDF: {file_path}")
-            return True, None
+            return True, file_path
+
+        except DownloadVerificationError as e:
+            error_msg = f"Verification failed: {e}"
+            if attempt < max_retries - 1:
+                telemetry.retry('http_pdf', e, pdf_url)
+                print(f"Rejected download of {pdf_url} ({e}), retrying...")
+            else:
+                return False, error_msg
 
-        except requests.exceptions.Timeout:
+        except requests.exceptions.Timeout as e:
             error_msg = f"Timeout error (attempt {attempt + 1}/{max_retries})"
             if attempt < max_retries - 1:
+                telemetry.retry('http_pdf', e, pdf_url)
                 print(f"Timeout downloading {pdf_url}, retrying in 2 seconds...")
                 time.sleep(2)
             else:
@@ -208,14 +216,81 @@ def sanitize_folder_name(name):
     sanitized_name = re.sub(invalid_chars, '', name)
     return re.sub(r'\s+', ' ', sanitized_name).strip()
 
+# Function to build a person's folder name the same way for every script
+def person_folder_name(folder_no, person_name):
+    # Replace any '/' in the name with a space and sanitize the name
+    person_name = person_name.replace('/', ' ')
+    person_name = sanitize_folder_name(person_name)
+
+    # Create folder name by appending 'No' value before the name
+    return f"{folder_no}_{person_name}"
+
+# Function to split a "Layout Link" cell into (link, drive_id, key) entries
+def plan_layout_links(drawing_links):
+    import pandas as pd
+
+    links = []
+    # Handle links (multiple links in "Layout Link")
+    if pd.notna(drawing_links):
+        for link in drawing_links.split(','):
+            link = link.strip()
+            drive_id = extract_drive_id(link)
+            links.append((link, drive_id, download_key(link, drive_id)))
+    return links
+
+# Function to download one row's planned layout links into person_folder
+# Returns (files processed, successful downloads, [(link, error), ...])
+def download_layouts_for_row(service, links, person_folder, shared):
+    total_files = 0
+    successful_downloads = 0
+    failures = []
+
+    os.makedirs(person_folder, exist_ok=True)
+
+    for link, drive_id, key in links:
+        total_files += 1
+
+        with shared.key_lock(key):
+            # Reuse a file another row already downloaded
+            if shared.lookup(key) is not None:
+                shared.materialise(key, person_folder)
+                successful_downloads += 1
+                continue
+
+            # Check if the link is a Google Drive link
+            # (result is the downloaded file path on success, the error message otherwise)
+            success = False
+            result = None
+
+            if drive_id:
+                print(f"Processing Google Drive file: {drive_id}")
+                success, result = download_file_from_gdrive(service, drive_id, person_folder)
+            elif link.endswith('.pdf'):
+                print(f"Processing direct PDF: {link}")
+                success, result = download_pdf(link, person_folder)
+            else:
+                print(f"Skipping non-PDF and non-Google Drive link: {link}")
+                continue
+
+            if success:
+                successful_downloads += 1
+                shared.remember(key, [result])
+            else:
+                failures.append((link, result))
+
+    return total_files, successful_downloads, failures
+
 # Function to save failed downloads to a CSV file for easy review
 def save_failed_downloads_to_csv(failed_downloads, filename="failed_downloads.csv"):
     if failed_downloads:
+        import pandas as pd
         df_failed = pd.DataFrame(failed_downloads, columns=['No', 'Name', 'Link', 'Error'])
         df_failed.to_csv(filename, index=False)
         print(f"\nFailed downloads saved to: {filename}")
 
-def main():
+def main(args=None):
+    import pandas as pd
+
     # Load your Excel file
     df = pd.read_excel(r'C:\Users\yewyn\Documents\Verdant\Batch 86.xlsx')
 
@@ -238,46 +313,32 @@ def main():
 
     print(f"Starting download for {len(df)} entries...\n")
 
+    # Plan the batch first so links shared by several rows are fetched only once
+    plan = []
     for index, row in df.iterrows():
-        drawing_links = row['Layout Link']
-        folder_no = row['No']
-        person_name = row['Name']
+        person_folder = os.path.join(base_download_path, person_folder_name(row['No'], row['Name']))
+        plan.append((index, row, person_folder, plan_layout_links(row['Layout Link'])))
 
-        # Replace any '/' in the name with a space and sanitize the name
-        person_name = person_name.replace('/', ' ')
-        person_name = sanitize_folder_name(person_name)
+    link_count, unique_count = count_unique([key for _, _, _, links in plan for _, _, key in links])
+    print(f"Planned {link_count} links, {unique_count} unique files to download\n")
 
-        # Create folder name by appending 'No' value before the name
-        person_folder = os.path.join(base_download_path, f"{folder_no}_{person_name}")
-        os.makedirs(person_folder, exist_ok=True)
+    shared = SharedDownloads()
 
-        # Handle links (multiple links in "Layout Link")
-        if pd.notna(drawing_links):
-            pdf_urls = drawing_links.split(',')
-            
-            for link in pdf_urls:
-                link = link.strip()
-                total_files += 1
-
-                # Check if the link is a Google Drive link
-                drive_id = extract_drive_id(link)
-                success = False
-                error = None
-
-                if drive_id:
-                    print(f"Processing Google Drive file: {drive_id}")
-                    success, error = download_file_from_gdrive(service, drive_id, person_folder)
-                elif link.endswith('.pdf'):
-                    print(f"Processing direct PDF: {link}")
-                    success, error = download_pdf(link, person_folder)
-                else:
-                    print(f"Skipping non-PDF and non-Google Drive link: {link}")
-                    continue
+    # When several machines share the batch folder, only download this node's rows
+    work = plan
+    sharding = sharding_from_args(args, base_download_path, 'layouts') if args else None
+    if sharding:
+        work = sharding.select([(os.path.basename(entry[2]), entry[1]['No'], entry) for entry in plan])
 
-                if success:
-                    successful_downloads += 1
-                else:
-                    failed_downloads.append((row['No'], row['Name'], link, error))
+    for index, row, person_folder, links in work:
+        row_files, row_successful, row_failures = download_layouts_for_row(service, links, person_folder, shared)
+        total_files += row_files
+        successful_downloads += row_successful
+        for link, error in row_failures:
+            failed_downloads.append((row['No'], row['Name'], link, error))
+        if sharding:
+            sharding.release(os.path.basename(person_folder), 'failed' if row_failures else 'ok', person_folder,
+                             '; '.join(error for _, error in row_failures))
 
         # Progress indicator
         if (index + 1) % 5 == 0:
@@ -291,6 +352,9 @@ def main():
     print(f"Successful downloads: {successful_downloads}")
     print(f"Failed downloads: {len(failed_downloads)}")
     print(f"Success rate: {(successful_downloads/total_files*100):.1f}%" if total_files > 0 else "No files processed")
+    print(shared.summary())
+    if sharding:
+        sharding.write_summary([os.path.basename(person_folder) for _, _, person_folder, _ in plan])
 
     # Print and save failed downloads
     if failed_downloads:
@@ -309,4 +373,15 @@ def main():
         print("\n✅ All layout downloads were successful!")
 
 if __name__ == "__main__":
-    main()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Download the layout PDFs for every row of the batch spreadsheet")
+    add_shard_arguments(parser)
+    add_telemetry_arguments(parser)
+    args = parser.parse_args()
+
+    configure_from_args(args)
+    try:
+        main(args)
+    finally:
+        telemetry.close()
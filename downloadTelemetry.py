@@ -0,0 +1,316 @@
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+# Download telemetry shared by downloadPDF, downloadAllFiles and pipeline.
+# Every Drive API call, Drive direct download and plain HTTP download is
+# recorded as one request event (type, host, outcome, error class, seconds,
+# bytes), and every retry as a retry event. From those it can
+#
+#   - append a JSON-lines event stream (--events FILE)
+#   - keep a Prometheus textfile up to date for node_exporter (--prometheus FILE)
+#   - show a one-line live progress display (--live)
+#   - print files/s, MB/s, p50/p95 latency per request type, retries and
+#     errors by class, per-host throughput and the slowest requests at the end
+#
+# Aggregation is always on and cheap; the outputs are only written when asked for.
+
+DRIVE_API_HOST = 'www.googleapis.com'
+
+# Request types that deliver a file (the rest are listings and metadata lookups)
+FILE_TYPES = {'drive_media', 'drive_thumbnail', 'drive_direct', 'http_pdf'}
+
+LATENCY_SAMPLES = 10000
+SLOWEST_KEPT = 5
+
+# Function to name the kind of failure an exception (or HTTP status) represents,
+# e.g. quota, timeout, network, not_found, server, html_page, verification
+def error_class(error):
+    if isinstance(error, str):
+        return error
+    if isinstance(error, int):
+        return status_class(error)
+
+    status = getattr(getattr(error, 'resp', None), 'status', None)  # googleapiclient HttpError
+    if status is None:
+        status = getattr(getattr(error, 'response', None), 'status_code', None)  # requests HTTPError
+    if status is not None:
+        reason = str(error).lower()
+        if int(status) in (403, 429) and ('rate' in reason or 'quota' in reason):
+            return 'quota'
+        return status_class(int(status))
+
+    if getattr(error, 'is_html', None) is not None:  # DownloadVerificationError
+        return 'html_page' if error.is_html else 'verification'
+
+    name = type(error).__name__
+    if 'Timeout' in name or isinstance(error, TimeoutError):
+        return 'timeout'
+    if 'Connection' in name or isinstance(error, ConnectionError):
+        return 'network'
+    return name
+
+def status_class(status):
+    if status == 429:
+        return 'quota'
+    if status == 404:
+        return 'not_found'
+    if status == 403:
+        return 'forbidden'
+    if status >= 500:
+        return 'server'
+    return f'http_{status}'
+
+def host_of(url):
+    return urlparse(url).netloc or url
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def format_bytes(size):
+    return f"{size / (1024 * 1024):.1f} MB"
+
+# One request in flight; callers set .bytes and .host, or call fail() for a
+# failure that didn't raise (e.g. a non-200 status that is handled inline)
+class RequestEvent:
+    def __init__(self, kind, target, host):
+        self.kind = kind
+        self.target = target
+        self.host = host
+        self.bytes = 0
+        self.failure = None
+        self.started = time.perf_counter()
+
+    def fail(self, error):
+        self.failure = error_class(error)
+
+class Telemetry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+        self.requests = defaultdict(int)                 # (type, outcome) -> count
+        self.bytes = defaultdict(int)                    # type -> bytes
+        self.seconds = defaultdict(float)                # type -> total seconds
+        self.latencies = defaultdict(lambda: deque(maxlen=LATENCY_SAMPLES))
+        self.errors = defaultdict(int)                   # (type, class) -> count
+        self.retries = defaultdict(int)                  # (type, class) -> count
+        self.host_bytes = defaultdict(int)
+        self.host_seconds = defaultdict(float)
+        self.slowest = []                                # [(seconds, type, target, bytes)]
+        self.in_flight = 0
+        self.files = 0
+        self.file_bytes = 0
+
+        self.events_file = None
+        self.prometheus_path = None
+        self.live = False
+        self.interval = 2.0
+        self.reporter = None
+        self.stop_reporting = threading.Event()
+
+    # Function to turn on the outputs; safe to skip entirely (nothing is written then)
+    def configure(self, events_path=None, prometheus_path=None, live=False, interval=2.0):
+        if events_path:
+            self.events_file = open(events_path, 'a', buffering=1)
+        self.prometheus_path = prometheus_path
+        self.live = live
+        self.interval = interval
+
+        if (prometheus_path or live) and self.reporter is None:
+            self.reporter = threading.Thread(target=self.report_loop, daemon=True)
+            self.reporter.start()
+
+    def emit(self, event):
+        if self.events_file:
+            event['ts'] = round(time.time(), 3)
+            self.events_file.write(json.dumps(event) + '\n')
+
+    # Context manager around one request attempt; an exception marks it failed (and is re-raised)
+    @contextmanager
+    def request(self, kind, target=None, host=DRIVE_API_HOST):
+        event = RequestEvent(kind, target, host)
+        with self.lock:
+            self.in_flight += 1
+        try:
+            yield event
+        except BaseException as e:
+            event.fail(e)
+            raise
+        finally:
+            self.finish(event)
+
+    def finish(self, event):
+        seconds = time.perf_counter() - event.started
+        outcome = 'error' if event.failure else 'ok'
+
+        with self.lock:
+            self.in_flight -= 1
+            self.requests[(event.kind, outcome)] += 1
+            self.seconds[event.kind] += seconds
+            self.latencies[event.kind].append(seconds)
+            self.bytes[event.kind] += event.bytes
+            self.host_bytes[event.host] += event.bytes
+            self.host_seconds[event.host] += seconds
+            if event.failure:
+                self.errors[(event.kind, event.failure)] += 1
+            elif event.kind in FILE_TYPES:
+                self.files += 1
+                self.file_bytes += event.bytes
+
+            self.slowest.append((seconds, event.kind, event.target, event.bytes))
+            self.slowest.sort(key=lambda item: item[0], reverse=True)
+            del self.slowest[SLOWEST_KEPT:]
+
+            self.emit({'event': 'request', 'type': event.kind, 'target': event.target, 'host': event.host,
+                       'outcome': outcome, 'error_class': event.failure, 'seconds': round(seconds, 4),
+                       'bytes': event.bytes})
+
+    # Record that a request of this type is about to be retried because of error
+    def retry(self, kind, error, target=None):
+        cls = error_class(error)
+        with self.lock:
+            self.retries[(kind, cls)] += 1
+            self.emit({'event': 'retry', 'type': kind, 'target': target, 'error_class': cls})
+
+    def elapsed(self):
+        return max(time.time() - self.started, 1e-6)
+
+    def live_line(self, previous):
+        now = time.time()
+        with self.lock:
+            files, file_bytes, in_flight = self.files, self.file_bytes, self.in_flight
+            retries = sum(self.retries.values())
+            errors = defaultdict(int)
+            for (_, cls), count in self.errors.items():
+                errors[cls] += count
+
+        last_time, last_files, last_bytes = previous
+        window = max(now - last_time, 1e-6)
+        error_text = ', '.join(f"{cls} {count}" for cls, count in sorted(errors.items())) or '0'
+        line = (f"{files} files {(files - last_files) / window:.1f}/s | {format_bytes(file_bytes)} "
+                f"{(file_bytes - last_bytes) / window / (1024 * 1024):.1f} MB/s | in flight {in_flight} | "
+                f"retries {retries} | errors {error_text}")
+        return line, (now, files, file_bytes)
+
+    def report_loop(self):
+        previous = (time.time(), 0, 0)
+        while not self.stop_reporting.wait(self.interval):
+            if self.live:
+                line, previous = self.live_line(previous)
+                if sys.stderr.isatty():
+                    sys.stderr.write('\r' + line[:150].ljust(150))
+                else:
+                    sys.stderr.write(line + '\n')
+                sys.stderr.flush()
+            if self.prometheus_path:
+                self.write_prometheus()
+
+    # Function to write all metrics in the Prometheus text format (atomically, for the textfile collector)
+    def write_prometheus(self):
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_text = ','.join(f'{key}="{val}"' for key, val in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+        with self.lock:
+            metric('endorse_download_requests_total', 'counter', 'Download and Drive API requests by type and outcome',
+                   [({'type': kind, 'outcome': outcome}, count) for (kind, outcome), count in sorted(self.requests.items())])
+            metric('endorse_download_bytes_total', 'counter', 'Bytes received by request type',
+                   [({'type': kind}, size) for kind, size in sorted(self.bytes.items())])
+            metric('endorse_download_errors_total', 'counter', 'Failed requests by type and error class',
+                   [({'type': kind, 'class': cls}, count) for (kind, cls), count in sorted(self.errors.items())])
+            metric('endorse_download_retries_total', 'counter', 'Retries by type and the error class that caused them',
+                   [({'type': kind, 'class': cls}, count) for (kind, cls), count in sorted(self.retries.items())])
+
+            latency_samples = []
+            for kind, samples in sorted(self.latencies.items()):
+                ordered = sorted(samples)
+                latency_samples.append(({'type': kind, 'quantile': '0.5'}, round(percentile(ordered, 0.5), 4)))
+                latency_samples.append(({'type': kind, 'quantile': '0.95'}, round(percentile(ordered, 0.95), 4)))
+            metric('endorse_download_latency_seconds', 'summary', 'Request latency by type', latency_samples)
+            lines.extend(f'endorse_download_latency_seconds_sum{{type="{kind}"}} {round(total, 4)}'
+                         for kind, total in sorted(self.seconds.items()))
+            lines.extend(f'endorse_download_latency_seconds_count{{type="{kind}"}} '
+                         f'{sum(count for (k, _), count in self.requests.items() if k == kind)}'
+                         for kind in sorted(self.seconds))
+
+            metric('endorse_download_host_bytes_total', 'counter', 'Bytes received by host',
+                   [({'host': host}, size) for host, size in sorted(self.host_bytes.items())])
+            metric('endorse_download_host_seconds_total', 'counter', 'Time spent in requests by host',
+                   [({'host': host}, round(seconds, 4)) for host, seconds in sorted(self.host_seconds.items())])
+            metric('endorse_download_in_flight', 'gauge', 'Requests currently in flight', [({}, self.in_flight)])
+            metric('endorse_download_files_total', 'counter', 'Files downloaded successfully', [({}, self.files)])
+
+        temp_path = self.prometheus_path + '.tmp'
+        with open(temp_path, 'w') as prom_file:
+            prom_file.write('\n'.join(lines) + '\n')
+        os.replace(temp_path, self.prometheus_path)
+
+    # Function to build the end-of-run report as text
+    def summary(self):
+        elapsed = self.elapsed()
+        with self.lock:
+            lines = [f"Telemetry: {self.files} files, {format_bytes(self.file_bytes)} in {elapsed:.1f}s "
+                     f"({self.files / elapsed:.2f} files/s, {self.file_bytes / elapsed / (1024 * 1024):.2f} MB/s)"]
+
+            lines.append(f"  {'type':<15}{'ok':>7}{'errors':>8}{'p50 s':>9}{'p95 s':>9}{'MB':>9}")
+            for kind in sorted(self.latencies):
+                ordered = sorted(self.latencies[kind])
+                lines.append(f"  {kind:<15}{self.requests[(kind, 'ok')]:>7}{self.requests[(kind, 'error')]:>8}"
+                             f"{percentile(ordered, 0.5):>9.2f}{percentile(ordered, 0.95):>9.2f}"
+                             f"{self.bytes[kind] / (1024 * 1024):>9.1f}")
+
+            for title, counts in (("Retries", self.retries), ("Errors", self.errors)):
+                if counts:
+                    lines.append(f"  {title} by class: " + ', '.join(
+                        f"{kind}/{cls} {count}" for (kind, cls), count in sorted(counts.items())))
+
+            for host in sorted(self.host_bytes):
+                if self.host_bytes[host]:
+                    rate = self.host_bytes[host] / max(self.host_seconds[host], 1e-6) / (1024 * 1024)
+                    lines.append(f"  {host}: {format_bytes(self.host_bytes[host])} at {rate:.2f} MB/s per request")
+
+            if self.slowest:
+                lines.append("  Slowest requests: " + '; '.join(
+                    f"{kind} {target} {seconds:.1f}s {format_bytes(size)}" for seconds, kind, target, size in self.slowest))
+        return '\n'.join(lines)
+
+    # Stop the reporter, write the final Prometheus file and print the summary
+    def close(self):
+        self.stop_reporting.set()
+        if self.reporter:
+            self.reporter.join()
+            self.reporter = None
+            if self.live and sys.stderr.isatty():
+                sys.stderr.write('\n')
+        if self.prometheus_path:
+            self.write_prometheus()
+        if self.events_file:
+            self.events_file.close()
+            self.events_file = None
+        print(self.summary())
+
+# Shared by every downloader in the process
+telemetry = Telemetry()
+
+# Function to add the telemetry options to a script's argparse parser
+def add_telemetry_arguments(parser):
+    parser.add_argument("--events", metavar="FILE", help="Append a JSON-lines event per request/retry to FILE")
+    parser.add_argument("--prometheus", metavar="FILE", help="Keep a Prometheus textfile-collector metrics file up to date")
+    parser.add_argument("--live", action="store_true", help="Show a live progress line (files/s, MB/s, retries, errors)")
+
+def configure_from_args(args):
+    telemetry.configure(args.events, args.prometheus, args.live)
@@ -0,0 +1,154 @@
+import hashlib
+import os
+import shutil
+import threading
+from urllib.parse import urlsplit, urlunsplit
+
+# Function to normalise a direct download URL so equivalent links compare equal
+def normalise_url(url):
+    parts = urlsplit(url.strip())
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip('/'), parts.query, ''))
+
+# Function to build the de-duplication key for a link (Drive ID if known, otherwise the URL)
+def download_key(link, drive_id=None):
+    if drive_id:
+        return ('drive', drive_id)
+    return ('url', normalise_url(link))
+
+# Function to place an already downloaded file into another folder.
+# Uses a hard link where the filesystem allows it and falls back to a copy.
+def link_file_into_folder(src_path, folder_path):
+    os.makedirs(folder_path, exist_ok=True)
+    dest_path = os.path.join(folder_path, os.path.basename(src_path))
+
+    if os.path.abspath(dest_path) == os.path.abspath(src_path):
+        return dest_path
+
+    if os.path.exists(dest_path):
+        os.remove(dest_path)
+
+    try:
+        os.link(src_path, dest_path)
+    except OSError:
+        shutil.copy2(src_path, dest_path)
+
+    return dest_path
+
+# Remembers the local files produced for each unique Drive ID / URL in a batch,
+# so rows pointing at the same object reuse the first download instead of
+# fetching it again. Safe to share between download threads: hold
+# key_lock(key) around the lookup/download/remember sequence.
+class SharedDownloads:
+    def __init__(self):
+        self.downloaded = {}
+        self.reused_files = 0
+        self.bytes_saved = 0
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def lookup(self, key):
+        return self.downloaded.get(key)
+
+    def remember(self, key, file_paths):
+        self.downloaded[key] = list(file_paths)
+
+    # Link every file previously downloaded for key into folder_path
+    def materialise(self, key, folder_path):
+        linked = []
+        for src_path in self.downloaded.get(key, []):
+            # Already in this folder (e.g. the same row planned twice): nothing was reused
+            if os.path.abspath(os.path.dirname(src_path)) == os.path.abspath(folder_path):
+                linked.append(src_path)
+                continue
+            linked.append(link_file_into_folder(src_path, folder_path))
+            with self._lock:
+                self.reused_files += 1
+                self.bytes_saved += os.path.getsize(src_path)
+        return linked
+
+    def summary(self):
+        return f"Reused {self.reused_files} already downloaded files, saved {self.bytes_saved / (1024 * 1024):.1f} MB of downloads"
+
+# Function to count links and unique objects in a download plan
+def count_unique(plan_keys):
+    return len(plan_keys), len(set(plan_keys))
+
+# Leading bytes expected for the file types the endorsement step reads
+MAGIC_BYTES = {
+    '.pdf': b'%PDF-',
+    '.jpg': b'\xff\xd8\xff',
+    '.jpeg': b'\xff\xd8\xff',
+    '.png': b'\x89PNG\r\n\x1a\n',
+}
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+class DownloadVerificationError(Exception):
+    def __init__(self, message, is_html=False):
+        super().__init__(message)
+        self.is_html = is_html
+
+# File-like wrapper that hashes, counts and sniffs the bytes as they are
+# written, so a download can be verified without reading the file back
+class VerifyingWriter:
+    def __init__(self, fh):
+        self.fh = fh
+        self.md5 = hashlib.md5()
+        self.size = 0
+        self.head = b''
+
+    def write(self, data):
+        if len(self.head) < 64:
+            self.head += data[:64 - len(self.head)]
+        self.md5.update(data)
+        self.size += len(data)
+        return self.fh.write(data)
+
+    # Raise DownloadVerificationError if the bytes written don't match what was expected
+    def verify(self, file_name, expected_md5=None, expected_size=None):
+        _, ext = os.path.splitext(file_name.lower())
+        magic = MAGIC_BYTES.get(ext)
+
+        # Exactly the bytes Drive holds: an extension that doesn't match the content
+        # (e.g. a PNG uploaded as .jpg) is how the file was named, not a bad download
+        if expected_md5 and self.md5.hexdigest() == expected_md5:
+            if magic and not self.head.startswith(magic):
+                print(f"Warning: {file_name} does not look like a {ext} file (starts with {self.head[:8]!r}), "
+                      f"but matches Drive's checksum")
+            return
+
+        start = self.head.lstrip()[:15].lower()
+        if start.startswith(b'<!doctype html') or start.startswith(b'<html'):
+            raise DownloadVerificationError(
+                f"Received an HTML page instead of {file_name} (Drive virus-scan or quota page)", is_html=True)
+
+        if magic and not self.head.startswith(magic):
+            raise DownloadVerificationError(f"{file_name} does not look like a {ext} file (starts with {self.head[:8]!r})")
+
+        if expected_size is not None and int(expected_size) != self.size:
+            raise DownloadVerificationError(f"{file_name} is {self.size} bytes, expected {expected_size}")
+
+        if expected_md5 and self.md5.hexdigest() != expected_md5:
+            raise DownloadVerificationError(f"{file_name} MD5 {self.md5.hexdigest()} does not match Drive checksum {expected_md5}")
+
+# Function to stream an HTTP response to file_path, verifying it on the way.
+# Bytes go to a .part file that only replaces file_path once verification passes.
+def stream_response_to_file(response, file_path, expected_md5=None, expected_size=None):
+    part_path = file_path + '.part'
+    try:
+        with open(part_path, 'wb') as fh:
+            writer = VerifyingWriter(fh)
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                writer.write(chunk)
+        writer.verify(os.path.basename(file_path), expected_md5, expected_size)
+    except Exception:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+
+    os.replace(part_path, file_path)
+    return writer.size
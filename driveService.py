@@ -0,0 +1,114 @@
+import os
+import pickle
+import threading
+
+# Shared Google Drive authentication for the downloader scripts.
+# The heavy Google client libraries are only imported when a service is
+# actually needed, the OAuth token is loaded/refreshed once per process and
+# the Drive v3 discovery document is cached on disk so later runs skip the
+# fetch/lookup entirely.
+
+SCOPES = ['https://www.googleapis.com/auth/drive']
+READONLY_SCOPES = ['https://www.googleapis.com/auth/drive.readonly']
+
+TOKEN_PATH = 'token.pickle'
+CREDENTIALS_PATH = 'credentials.json'
+DISCOVERY_CACHE_PATH = 'drive_v3_discovery.json'
+DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/drive/v3/rest'
+
+_creds = None
+_creds_lock = threading.Lock()
+_discovery_doc = None
+_thread_state = threading.local()
+
+# Function to load (and if needed refresh) the user's credentials, once per process
+def load_credentials(scopes=SCOPES):
+    global _creds
+
+    with _creds_lock:
+        if _creds is not None and _creds.valid:
+            return _creds
+
+        creds = _creds
+
+        # Token file stores the user's access and refresh tokens
+        if creds is None and os.path.exists(TOKEN_PATH):
+            with open(TOKEN_PATH, 'rb') as token:
+                creds = pickle.load(token)
+
+        # If there are no valid credentials, refresh or ask the user to log in
+        if not creds or not creds.valid:
+            if creds and creds.expired and creds.refresh_token:
+                from google.auth.transport.requests import Request
+                creds.refresh(Request())
+            else:
+                from google_auth_oauthlib.flow import InstalledAppFlow
+                flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_PATH, scopes)
+                creds = flow.run_local_server(port=0)
+
+            # Save the credentials for the next run
+            with open(TOKEN_PATH, 'wb') as token:
+                pickle.dump(creds, token)
+
+        _creds = creds
+        return creds
+
+# Function to get the Drive v3 discovery document, cached on disk between runs
+def load_discovery_document():
+    global _discovery_doc
+
+    if _discovery_doc is not None:
+        return _discovery_doc
+
+    if os.path.exists(DISCOVERY_CACHE_PATH):
+        with open(DISCOVERY_CACHE_PATH, 'r', encoding='utf-8') as cache_file:
+            _discovery_doc = cache_file.read()
+        return _discovery_doc
+
+    # Prefer the copy bundled with google-api-python-client, fall back to the network
+    doc = None
+    try:
+        from googleapiclient.discovery_cache import get_static_doc
+        doc = get_static_doc('drive', 'v3')
+    except ImportError:
+        pass
+
+    if not doc:
+        import requests
+        response = requests.get(DISCOVERY_URL, timeout=30)
+        response.raise_for_status()
+        doc = response.text
+
+    try:
+        with open(DISCOVERY_CACHE_PATH, 'w', encoding='utf-8') as cache_file:
+            cache_file.write(doc)
+    except OSError as e:
+        print(f"Could not cache Drive discovery document: {e}")
+
+    _discovery_doc = doc
+    return doc
+
+# Function to get a Drive service, built once per thread and reused afterwards
+# (googleapiclient service objects are not safe to share between threads)
+def get_drive_service(scopes=SCOPES):
+    service = getattr(_thread_state, 'service', None)
+    if service is not None:
+        return service
+
+    creds = load_credentials(scopes)
+
+    from googleapiclient.discovery import build_from_document
+    service = build_from_document(load_discovery_document(), credentials=creds)
+
+    _thread_state.service = service
+    return service
+
+# Kept under the old name used by the downloader scripts
+def authenticate_gdrive(scopes=SCOPES):
+    return get_drive_service(scopes)
+
+# Function to get headers for plain HTTP requests to Google (e.g. thumbnail links)
+# made with the same credentials as the Drive service
+def authorization_headers(scopes=SCOPES):
+    creds = load_credentials(scopes)
+    return {'Authorization': f'Bearer {creds.token}'}
@@ -0,0 +1,380 @@
+import json
+import hashlib
+import os
+from datetime import datetime, timedelta, timezone
+
+from downloadAllFiles import is_image_file, download_photo, PHOTO_FIELDS
+from downloadUtils import link_file_into_folder
+from downloadTelemetry import telemetry
+
+# Incremental sync of a batch's Drive photo folders (downloadAllFiles --sync).
+#
+# The first sync lists every folder once and records, per Drive folder (or
+# single file link), which Drive file IDs were downloaded into which person
+# folders. Later syncs only ask Drive what changed since then:
+#
+#   changes   - the Drive changes feed from the start page token saved last
+#               time: one or two calls for the whole batch, however many folders
+#   modified  - "modifiedTime > last sync" queries over many folders at once,
+#               plus an ID-only listing to notice deleted files; for accounts
+#               where the changes feed is not usable
+#
+# New and modified photos are downloaded, and the local copies of photos
+# removed (or trashed, or moved out of the folder) upstream are deleted.
+# Only files the sync downloaded itself are ever deleted. State is kept in
+# "<batch>/.sync/photos.json"; the dot folder is skipped by run.py.
+
+SYNC_DIR_NAME = '.sync'
+STATE_FILE_NAME = 'photos.json'
+SYNC_MODES = ('changes', 'modified')
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+# Fields for listings; download_photo needs PHOTO_FIELDS, the sync the rest
+SYNC_FIELDS = f"{PHOTO_FIELDS}, parents, trashed, modifiedTime"
+CHANGE_FIELDS = f"nextPageToken, newStartPageToken, changes(fileId, removed, file({SYNC_FIELDS}))"
+
+# Parent folders per files().list query in modified mode (keeps the query short)
+PARENTS_PER_QUERY = 40
+
+# Look back a little before the last sync so clock skew can't lose a change;
+# files seen again are recognised by their checksum and skipped
+MODIFIED_OVERLAP = timedelta(minutes=10)
+
+def utc_timestamp(moment):
+    return moment.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+
+class DriveSync:
+    def __init__(self, service, batch_folder, photo_size=None, mode='changes'):
+        if mode not in SYNC_MODES:
+            raise ValueError(f"Unknown sync mode: {mode} (choose from {', '.join(SYNC_MODES)})")
+
+        self.service = service
+        self.batch_folder = batch_folder
+        self.photo_size = photo_size
+        self.mode = mode
+        self.state_path = os.path.join(batch_folder, SYNC_DIR_NAME, STATE_FILE_NAME)
+        self.state = self.load_state()
+
+        self.items = {}  # Drive file ID -> metadata from this run (thumbnail links expire)
+        self.api_calls = 0
+        self.downloaded = 0
+        self.removed = 0
+        self.failed = []  # (person folder, file name, error)
+
+    def load_state(self):
+        if os.path.exists(self.state_path):
+            with open(self.state_path, 'r', encoding='utf-8') as state_file:
+                return json.load(state_file)
+        # targets: Drive ID -> {'type', 'folders': [person folders], 'files': {file ID: record}}
+        return {'start_page_token': None, 'last_sync': None, 'targets': {}}
+
+    def save_state(self):
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        with open(self.state_path + '.tmp', 'w', encoding='utf-8') as state_file:
+            json.dump(self.state, state_file, indent=1)
+        os.replace(self.state_path + '.tmp', self.state_path)
+
+    def execute(self, kind, target, request):
+        self.api_calls += 1
+        with telemetry.request(kind, target):
+            return request.execute()
+
+    def start_page_token(self):
+        return self.execute('drive_changes', 'start', self.service.changes().getStartPageToken(
+            supportsAllDrives=True))['startPageToken']
+
+    # Function to sync the given rows: [(person folder, Drive ID, 'file' or 'folder')]
+    def sync(self, rows):
+        started = datetime.now(timezone.utc)
+        targets = self.state['targets']
+
+        # Person folders are stored relative to the batch so the batch can be moved
+        wanted = {}
+        for person_folder, drive_id, drive_type in rows:
+            target = wanted.setdefault(drive_id, {'type': drive_type, 'folders': []})
+            folder = os.path.relpath(person_folder, self.batch_folder)
+            if folder not in target['folders']:
+                target['folders'].append(folder)
+
+        # Rows taken out of the spreadsheet are no longer synced (their files are kept)
+        for drive_id in set(targets) - set(wanted):
+            print(f"No longer syncing {drive_id} ({', '.join(targets.pop(drive_id)['folders'])})")
+
+        new_ids = []
+        for drive_id, target in wanted.items():
+            if drive_id in targets:
+                targets[drive_id]['folders'] = target['folders']
+            else:
+                targets[drive_id] = {'type': target['type'], 'folders': target['folders'], 'files': {}}
+                new_ids.append(drive_id)
+
+        known_ids = [drive_id for drive_id in targets if drive_id not in new_ids]
+        previous_token = self.state['start_page_token']
+        if self.mode == 'changes':
+            # Take the token before listing anything so nothing changes unseen in between
+            if previous_token is None:
+                self.state['start_page_token'] = self.start_page_token()
+        else:
+            # A token is only valid while the feed is followed every run
+            self.state['start_page_token'] = None
+
+        if known_ids:
+            if self.mode == 'changes' and previous_token:
+                try:
+                    self.apply_changes(previous_token)
+                except Exception as e:
+                    # Tokens can expire; list everything once and carry on from the new token
+                    print(f"Drive changes feed failed ({e}), listing every folder instead")
+                    self.state['start_page_token'] = self.start_page_token()
+                    new_ids.extend(known_ids)
+            elif self.state['last_sync']:
+                # Modified mode, or switching over from it to the changes feed
+                self.apply_modified_since(known_ids)
+            else:
+                new_ids.extend(known_ids)
+
+        for drive_id in new_ids:
+            self.reconcile(drive_id)
+
+        for drive_id in list(targets):
+            self.materialise(drive_id)
+
+        self.state['last_sync'] = utc_timestamp(started)
+        self.save_state()
+
+        print(f"Drive sync ({self.mode}): {len(new_ids)} folders listed in full, {self.api_calls} API calls, "
+              f"{self.downloaded} photos downloaded, {self.removed} removed, {len(self.failed)} failed")
+        return self.downloaded, self.removed, self.failed
+
+    # Function to apply the Drive changes feed from page_token to the tracked folders
+    def apply_changes(self, page_token):
+        changes = []
+        new_token = None
+        while page_token:
+            response = self.execute('drive_changes', page_token, self.service.changes().list(
+                pageToken=page_token,
+                fields=CHANGE_FIELDS,
+                pageSize=1000,
+                includeRemoved=True,
+                supportsAllDrives=True,
+                includeItemsFromAllDrives=True
+            ))
+            changes.extend(response.get('changes', []))
+            page_token = response.get('nextPageToken')
+            new_token = response.get('newStartPageToken', new_token)
+
+        targets = self.state['targets']
+        for change in changes:
+            file_id = change.get('fileId')
+            item = change.get('file')
+            gone = change.get('removed') or item is None or item.get('trashed')
+
+            target = targets.get(file_id)
+            if target is not None and target['type'] == 'folder':
+                # The shared folder itself: trashed or unshared means all its photos are gone
+                if gone:
+                    self.remove_all(file_id)
+                    target['gone'] = True
+                elif target.pop('gone', False):
+                    self.reconcile(file_id)
+                continue
+
+            self.apply_item(file_id, None if gone else item)
+
+        if new_token:
+            self.state['start_page_token'] = new_token
+        print(f"Drive changes feed: {len(changes)} changes since the last sync")
+
+    # Function to catch up with "modified since the last sync" queries (modified mode)
+    def apply_modified_since(self, drive_ids):
+        targets = self.state['targets']
+        since = utc_timestamp(datetime.fromisoformat(self.state['last_sync']).replace(tzinfo=timezone.utc) - MODIFIED_OVERLAP)
+
+        folder_ids = [drive_id for drive_id in drive_ids if targets[drive_id]['type'] == 'folder']
+        for start in range(0, len(folder_ids), PARENTS_PER_QUERY):
+            chunk = folder_ids[start:start + PARENTS_PER_QUERY]
+            parents = ' or '.join(f"'{folder_id}' in parents" for folder_id in chunk)
+
+            # createdTime too: uploads can keep the photo's original modified time
+            for item in self.list_files(f"({parents}) and trashed = false and "
+                                        f"(modifiedTime > '{since}' or createdTime > '{since}')", SYNC_FIELDS):
+                self.apply_item(item['id'], item)
+
+            # Deleted files don't show up in a time query, so compare the IDs still there
+            present = {}
+            for item in self.list_files(f"({parents}) and trashed = false", "id, parents"):
+                for parent in item.get('parents', []):
+                    present.setdefault(parent, set()).add(item['id'])
+            for folder_id in chunk:
+                for file_id in set(targets[folder_id]['files']) - present.get(folder_id, set()):
+                    self.remove_file(folder_id, file_id)
+
+        for drive_id in drive_ids:
+            if targets[drive_id]['type'] == 'file':
+                self.reconcile(drive_id)
+
+    # Function to list every file matching query (all pages)
+    def list_files(self, query, fields):
+        items = []
+        page_token = None
+        while True:
+            response = self.execute('drive_list', None, self.service.files().list(
+                q=query,
+                fields=f"nextPageToken, files({fields})",
+                pageSize=1000,
+                pageToken=page_token,
+                supportsAllDrives=True,
+                includeItemsFromAllDrives=True
+            ))
+            items.extend(response.get('files', []))
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return items
+
+    # Function to list one tracked folder (or fetch one tracked file) in full and apply the differences
+    def reconcile(self, drive_id):
+        target = self.state['targets'][drive_id]
+
+        if target['type'] == 'file':
+            try:
+                item = self.execute('drive_metadata', drive_id,
+                                    self.service.files().get(fileId=drive_id, fields=SYNC_FIELDS, supportsAllDrives=True))
+            except Exception as e:
+                if getattr(getattr(e, 'resp', None), 'status', None) != 404:
+                    raise
+                item = None
+            self.apply_file(drive_id, drive_id, None if item is None or item.get('trashed') else item)
+            return
+
+        items = self.list_files(f"'{drive_id}' in parents and trashed = false", SYNC_FIELDS)
+        listed = set()
+        for item in items:
+            listed.add(item['id'])
+            self.apply_file(drive_id, item['id'], item)
+        for file_id in set(target['files']) - listed:
+            self.remove_file(drive_id, file_id)
+
+    # Function to apply a file's current metadata (None when it is gone) to every tracked folder it was or is in
+    def apply_item(self, file_id, item):
+        targets = self.state['targets']
+        parents = set(item.get('parents', [])) if item else set()
+
+        for drive_id, target in targets.items():
+            if drive_id == file_id and target['type'] == 'file':
+                self.apply_file(drive_id, file_id, item)
+            elif target['type'] == 'folder':
+                if drive_id in parents:
+                    self.apply_file(drive_id, file_id, item)
+                elif file_id in target['files']:
+                    self.remove_file(drive_id, file_id)
+
+    def apply_file(self, drive_id, file_id, item):
+        target = self.state['targets'][drive_id]
+        if item is None or not is_image_file(item.get('name'), item.get('mimeType')) or item.get('mimeType') == FOLDER_MIME_TYPE:
+            if file_id in target['files']:
+                self.remove_file(drive_id, file_id)
+            return
+
+        self.items[file_id] = item
+        record = target['files'].get(file_id)
+        if record is not None:
+            unchanged = record['name'] == item['name'] and (
+                record['md5'] == item.get('md5Checksum') if record['md5'] else record['modified'] == item.get('modifiedTime'))
+            if unchanged:
+                return
+            # Changed upstream: drop the old copies, materialise downloads the new one
+            self.delete_local(target, record)
+
+        target['files'][file_id] = {'name': item['name'], 'md5': item.get('md5Checksum'),
+                                    'modified': item.get('modifiedTime'), 'local': None, 'photo_size': None}
+
+    def remove_file(self, drive_id, file_id):
+        target = self.state['targets'][drive_id]
+        record = target['files'].pop(file_id)
+        if self.delete_local(target, record):
+            self.removed += 1
+            print(f"Removed {record['local']} from {', '.join(target['folders'])} (deleted on Drive)")
+
+    def remove_all(self, drive_id):
+        for file_id in list(self.state['targets'][drive_id]['files']):
+            self.remove_file(drive_id, file_id)
+
+    # Delete a file's local copies from the target's person folders; returns whether any existed
+    def delete_local(self, target, record):
+        deleted = False
+        if record['local']:
+            for folder in target['folders']:
+                local_path = os.path.join(self.batch_folder, folder, record['local'])
+                if os.path.exists(local_path):
+                    os.remove(local_path)
+                    deleted = True
+        return deleted
+
+    # Function to make sure every tracked photo exists in each of the target's person folders,
+    # downloading new and changed ones once and linking them into the other folders
+    def materialise(self, drive_id):
+        target = self.state['targets'][drive_id]
+        folders = [os.path.join(self.batch_folder, folder) for folder in target['folders']]
+        downloaded = 0
+
+        for file_id, record in target['files'].items():
+            if record['local'] and record['photo_size'] != self.photo_size:
+                # Asked for a different resolution than last time
+                self.delete_local(target, record)
+                record['local'] = None
+
+            if record['local'] is None:
+                record['local'] = self.adopt_existing(folders[0], record)
+
+            existing = [folder for folder in folders
+                        if record['local'] and os.path.exists(os.path.join(folder, record['local']))]
+            if not existing:
+                try:
+                    item = self.items.get(file_id) or self.execute('drive_metadata', file_id, self.service.files().get(
+                        fileId=file_id, fields=SYNC_FIELDS, supportsAllDrives=True))
+                    file_path = download_photo(self.service, item, folders[0], self.photo_size)
+                except Exception as e:
+                    record['local'] = None
+                    self.failed.append((os.path.basename(folders[0]), record['name'], str(e)))
+                    continue
+                record['local'] = os.path.basename(file_path)
+                record['photo_size'] = self.photo_size
+                self.downloaded += 1
+                downloaded += 1
+                existing = [folders[0]]
+
+            for folder in folders:
+                if folder not in existing:
+                    link_file_into_folder(os.path.join(existing[0], record['local']), folder)
+
+        if downloaded:
+            print(f"Synced {', '.join(target['folders'])}: {downloaded} photos downloaded")
+
+    # On the first sync of an already downloaded batch, reuse the files already there
+    def adopt_existing(self, folder, record):
+        base_name = os.path.splitext(record['name'])[0]
+        candidates = [record['name']]
+        if self.photo_size:
+            candidates += [base_name + '.jpg', base_name + '.png']
+
+        for candidate in candidates:
+            local_path = os.path.join(folder, candidate)
+            if not os.path.exists(local_path):
+                continue
+            # An original from an earlier full-resolution run must still match Drive's checksum
+            if candidate == record['name'] and record['md5'] and not self.photo_size:
+                with open(local_path, 'rb') as local_file:
+                    if hashlib.md5(local_file.read()).hexdigest() != record['md5']:
+                        continue
+            record['photo_size'] = self.photo_size
+            return candidate
+        return None
+
+# Function to add the sync options to a script's argparse parser
+def add_sync_arguments(parser):
+    parser.add_argument("--sync", action="store_true",
+                        help="Only fetch photos added or changed on Drive since the last --sync, and delete local "
+                             "copies of photos removed there (state in <batch>/.sync)")
+    parser.add_argument("--sync-mode", choices=SYNC_MODES, default="changes",
+                        help="Find changes with the Drive changes feed, or with modifiedTime queries")
@@ -0,0 +1,328 @@
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from pdfEngines import pymupdf_available
+
+# Runs endorsement jobs (run.process_pdf_with_stamp_and_images) in parallel
+# without running out of memory. Before a job starts its peak memory is
+# estimated from the layout PDF (file size and page count) and the photos
+# (pixel dimensions read from the file headers, without decoding, and file
+# sizes). Jobs are then started against a RAM budget:
+#
+#   - small jobs are packed together, largest first, while they fit the budget
+#     and there are free workers; a job that has been passed over for smaller
+#     ones MAX_PASSED_OVER times stops the backfilling until it fits
+#   - huge jobs (over half the budget) run on their own in a fresh process,
+#     once everything else has finished, so their memory is handed back after
+#   - photos over max_image_pixels (decompression bombs) are refused up front
+#
+# The per-engine figures below were measured on synthetic batches (peak RSS of
+# one job in its own process started from the shell, re-checked against VmHWM)
+# and are deliberately on the high side.
+
+MB = 1024 * 1024
+GB = 1024 * MB
+
+# Per engine: process baseline, bytes per byte of layout PDF, bytes per page,
+# bytes per pixel of the largest photo (JPEG / other formats, which are decoded),
+# and bytes per byte of every photo file
+MEMORY_MODELS = {
+    'pypdf2': {'base': 40 * MB, 'layout': 60, 'page': MB // 2, 'jpeg_pixel': 9, 'pixel': 46, 'image_file': 2},
+    'pymupdf': {'base': 70 * MB, 'layout': 3, 'page': MB // 10, 'jpeg_pixel': 0, 'pixel': 10, 'image_file': 2},
+}
+SAFETY_FACTOR = 1.25
+
+JPEG_EXTENSIONS = ('.jpg', '.jpeg')
+
+# Share of the available memory used when no budget is given, and the budget
+# when the available memory can't be read
+AVAILABLE_MEMORY_SHARE = 0.8
+FALLBACK_BUDGET = 4 * GB
+
+# Jobs estimated at more than this share of the budget run on their own
+HUGE_JOB_SHARE = 0.5
+
+# Rounds a waiting job may watch smaller jobs start ahead of it before they are held back
+MAX_PASSED_OVER = 3
+
+def default_max_image_pixels():
+    from PIL import Image
+    return 2 * Image.MAX_IMAGE_PIXELS  # where Pillow itself refuses to open an image
+
+class ImageTooLargeError(Exception):
+    pass
+
+# One job's estimate: peak bytes, layout page count and the pixels of its largest photo
+JobEstimate = namedtuple('JobEstimate', ['peak_bytes', 'pages', 'largest_image_pixels'])
+
+# Function to read the available physical memory in bytes, or None if it can't be read here
+def available_memory():
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def count_pdf_pages(pdf_path):
+    from PyPDF2 import PdfReader
+    return len(PdfReader(pdf_path, strict=False).pages)
+
+# Function to read an image's pixel dimensions from its header (the pixels are not decoded).
+# Raises ImageTooLargeError for images over max_pixels.
+def image_dimensions(image_path, max_pixels):
+    from PIL import Image
+    import warnings
+
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+            with Image.open(image_path) as image:
+                width, height = image.size
+    except Image.DecompressionBombError as e:
+        raise ImageTooLargeError(f"{os.path.basename(image_path)}: {e}")
+
+    if max_pixels and width * height > max_pixels:
+        raise ImageTooLargeError(f"{os.path.basename(image_path)} is {width}x{height} ({width * height / 1e6:.0f} MP), "
+                                 f"over the {max_pixels / 1e6:.0f} MP limit")
+    return width, height
+
+# Function to refuse a job up front if any of its photos is over max_pixels (None means the default)
+def check_image_sizes(image_files, max_pixels=None):
+    if max_pixels is None:
+        max_pixels = default_max_image_pixels()
+    for image_path in image_files:
+        image_dimensions(image_path, max_pixels)
+
+def engine_name(engine):
+    if engine is not None and not isinstance(engine, str):
+        return engine.name
+    name = engine or 'pypdf2'
+    if name == 'auto':
+        name = 'pymupdf' if pymupdf_available() else 'pypdf2'
+    return name
+
+# Function to estimate the peak memory of endorsing one person folder.
+# Raises ImageTooLargeError if a photo is over max_image_pixels.
+def estimate_job_memory(layout_pdf, image_files, engine=None, max_image_pixels=None):
+    model = MEMORY_MODELS[engine_name(engine)]
+    if max_image_pixels is None:
+        max_image_pixels = default_max_image_pixels()
+
+    layout_size = os.path.getsize(layout_pdf)
+    try:
+        pages = count_pdf_pages(layout_pdf)
+    except Exception:
+        pages = 1  # Let the job itself report a damaged PDF
+
+    # Photos are added one at a time, so only the largest is decoded at once;
+    # every photo's compressed data stays in the document until it is written
+    largest_image_pixels = 0
+    largest_image_bytes = 0
+    image_file_bytes = 0
+    for image_path in image_files:
+        width, height = image_dimensions(image_path, max_image_pixels)
+        per_pixel = model['jpeg_pixel'] if image_path.lower().endswith(JPEG_EXTENSIONS) else model['pixel']
+        largest_image_bytes = max(largest_image_bytes, width * height * per_pixel)
+        largest_image_pixels = max(largest_image_pixels, width * height)
+        image_file_bytes += os.path.getsize(image_path)
+
+    peak = (model['base'] + layout_size * model['layout'] + pages * model['page']
+            + largest_image_bytes + image_file_bytes * model['image_file'])
+    return JobEstimate(int(peak * SAFETY_FACTOR), pages, largest_image_pixels)
+
+# Runs in a worker process; returns the output path (the engine's document stays in the worker)
+def endorse(layout_pdf, image_files, stamp_image_path, output_pdf_path, optimise=False, fit_to_page=False, engine=None):
+    from run import process_pdf_with_stamp_and_images
+    process_pdf_with_stamp_and_images(layout_pdf, image_files, stamp_image_path, output_pdf_path, optimise, fit_to_page, engine)
+    return output_pdf_path
+
+class MemoryScheduler:
+    def __init__(self, workers=None, memory_budget=None, max_image_pixels=None):
+        self.workers = workers or os.cpu_count() or 1
+        if memory_budget is None:
+            available = available_memory()
+            if available is None:
+                print(f"Could not read the available memory, assuming a {FALLBACK_BUDGET / GB:.0f} GB budget "
+                      f"(set one with --memory-budget)")
+                memory_budget = FALLBACK_BUDGET
+            else:
+                memory_budget = int(available * AVAILABLE_MEMORY_SHARE)
+        self.memory_budget = memory_budget
+        self.max_image_pixels = max_image_pixels if max_image_pixels is not None else default_max_image_pixels()
+
+        self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.queue = []        # [(estimate, label, outer future, args)]
+        self.running = 0
+        self.reserved = 0      # estimated bytes of the running jobs
+        self.isolated = False  # a huge job is running on its own
+        self.passed_over = {}  # outer future -> rounds smaller jobs started ahead of it
+
+        print(f"Scheduling endorsements on {self.workers} workers within {self.memory_budget / GB:.1f} GB")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    # Function to queue one endorsement (same arguments as process_pdf_with_stamp_and_images).
+    # Returns a Future for the output path; refused jobs fail with ImageTooLargeError.
+    def submit(self, layout_pdf, image_files, stamp_image_path, output_pdf_path, optimise=False, fit_to_page=False, engine=None):
+        future = Future()
+        try:
+            estimate = estimate_job_memory(layout_pdf, image_files, engine, self.max_image_pixels)
+        except Exception as e:
+            future.set_exception(e)
+            return future
+
+        args = (layout_pdf, image_files, stamp_image_path, output_pdf_path, optimise, fit_to_page, engine)
+        with self.lock:
+            self.queue.append((estimate.peak_bytes, os.path.basename(layout_pdf), future, args))
+            self.start_ready()
+        return future
+
+    # Block until a new job would start straight away: nothing queued and a worker free.
+    # Callers that claim shared work (shardWork claim mode) call this before claiming
+    # the next folder, so unstarted folders stay free for other nodes.
+    def wait_for_free_worker(self):
+        with self.lock:
+            while self.queue or self.running >= self.workers:
+                self.idle.wait()
+
+    def is_huge(self, peak_bytes):
+        return peak_bytes > self.memory_budget * HUGE_JOB_SHARE
+
+    # Start whatever fits now (called with the lock held)
+    def start_ready(self):
+        if self.isolated:
+            return
+
+        # Largest first, and small ones fill the gaps; the largest job that doesn't fit
+        # yet is only passed over MAX_PASSED_OVER times, then the running jobs drain for it
+        self.queue.sort(key=lambda job: job[0], reverse=True)
+        blocked = None
+        backfilled = False
+        for job in list(self.queue):
+            peak_bytes, label, future = job[0], job[1], job[2]
+            if self.is_huge(peak_bytes):
+                # Wait for the running jobs to finish, then run it alone
+                if self.running:
+                    return
+                self.queue.remove(job)
+                if self.start(job, isolated=True):
+                    if peak_bytes > self.memory_budget:
+                        print(f"{label} is estimated at {peak_bytes / GB:.1f} GB, over the "
+                              f"{self.memory_budget / GB:.1f} GB budget; running it alone")
+                    else:
+                        print(f"Running {label} on its own (estimated {peak_bytes / GB:.1f} GB)")
+                    return
+                # Cancelled or couldn't be started: carry on with the rest of the queue
+                continue
+
+            if self.running >= self.workers or self.reserved + peak_bytes > self.memory_budget:
+                if blocked is None:
+                    blocked = future
+                continue
+            if blocked is not None and self.passed_over.get(blocked, 0) >= MAX_PASSED_OVER:
+                break
+            self.queue.remove(job)
+            if self.start(job, isolated=False) and blocked is not None:
+                backfilled = True
+
+        if backfilled:
+            self.passed_over[blocked] = self.passed_over.get(blocked, 0) + 1
+
+    # A worker that dies (e.g. OOM-killed) breaks the whole pool; start a new one for the jobs still to come
+    def replace_pool(self, broken_pool):
+        if self.pool is broken_pool:
+            print("A worker process died, starting a new process pool")
+            self.pool = ProcessPoolExecutor(max_workers=self.workers)
+            broken_pool.shutdown(wait=False)
+
+    # Function to start one job (called with the lock held); returns whether it is now running
+    def start(self, job, isolated):
+        peak_bytes, _, future, args = job
+        self.passed_over.pop(future, None)
+        if not future.set_running_or_notify_cancel():
+            return False
+
+        # A fresh process for a huge job, so the memory it used goes back to the system
+        pool = ProcessPoolExecutor(max_workers=1) if isolated else self.pool
+        try:
+            inner = pool.submit(endorse, *args)
+        except BrokenProcessPool:
+            self.replace_pool(pool)
+            pool = self.pool
+            try:
+                inner = pool.submit(endorse, *args)
+            except Exception as e:
+                future.set_exception(e)
+                return False
+        except Exception as e:
+            future.set_exception(e)
+            return False
+
+        self.running += 1
+        self.reserved += peak_bytes
+        self.isolated = isolated
+        inner.add_done_callback(lambda done: self.finished(job, done, pool, isolated))
+        return True
+
+    def finished(self, job, done, pool, isolated):
+        peak_bytes, _, future, _ = job
+        error = done.exception()
+        with self.lock:
+            self.running -= 1
+            self.reserved -= peak_bytes
+            if isolated:
+                self.isolated = False
+            elif isinstance(error, BrokenProcessPool):
+                # This job (or one running beside it) took the pool down; the queued ones get a new pool
+                self.replace_pool(pool)
+            self.start_ready()
+            self.idle.notify_all()
+
+        if isolated:
+            pool.shutdown(wait=False)
+
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(done.result())
+
+    def shutdown(self):
+        # Queued jobs are cancelled; the running ones are waited for
+        with self.lock:
+            for _, _, future, _ in self.queue:
+                future.cancel()
+            self.queue = []
+            self.passed_over = {}
+            while self.running:
+                self.idle.wait()
+        self.pool.shutdown(wait=True)
+
+# Function to add the memory scheduling options to a script's argparse parser
+def add_memory_arguments(parser):
+    parser.add_argument("--memory-budget", type=float, metavar="GB",
+                        help="RAM the parallel endorsements may use together (default: 80%% of the memory available at start)")
+    parser.add_argument("--max-image-megapixels", type=float, metavar="MP",
+                        help="Refuse photos larger than this (default: where Pillow refuses them, about 179 MP)")
+
+# Function to turn those options into (memory budget in bytes, max image pixels), None meaning the default
+def memory_limits_from_args(args):
+    memory_budget = int(args.memory_budget * GB) if args.memory_budget else None
+    max_image_pixels = int(args.max_image_megapixels * 1e6) if args.max_image_megapixels else None
+    return memory_budget, max_image_pixels
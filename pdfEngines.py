@@ -0,0 +1,373 @@
+import os
+from io import BytesIO
+from PyPDF2 import PdfReader, PdfWriter, PageObject
+from PyPDF2.generic import ArrayObject, DecodedStreamObject, IndirectObject, NameObject, NumberObject, RectangleObject
+from PIL import Image
+from reportlab.pdfgen import canvas
+from reportlab.lib.pagesizes import landscape, A4
+from reportlab.lib.utils import ImageReader
+from pdfOptimise import write_pdf
+
+# PDF engines for run.process_pdf_with_stamp_and_images. An engine provides
+#
+#   stamp(layout_pdf, stamp_image_path, temp_path)  -> stamped document
+#   to_landscape_a4(stamped, fit_to_page)           -> output document
+#   add_image_page(document, image_path)
+#   write(document, output_pdf_path, optimise)      -> object with .pages (for the combined PDF)
+#
+# "pypdf2" (PyPDF2Engine, pure Python PyPDF2 + reportlab) is the default.
+# "pymupdf" does the same work in MuPDF's C library when PyMuPDF is installed:
+# the stamp image is embedded once per document, sheets are placed as form
+# XObjects instead of being parsed and merged in Python, and nothing goes
+# through a temporary file. "auto" picks pymupdf when it is available.
+#
+# Both engines place things with the helpers below, so stamp and photo
+# positions match; benchmarkEngines.py checks that on a synthetic batch.
+
+ENGINE_NAMES = ('pypdf2', 'pymupdf', 'auto')
+
+A4_LANDSCAPE = landscape(A4)
+
+# Exact DPI of the reference stamp and its offset from the top right corner
+STAMP_DPI = (295, 301)
+STAMP_RIGHT_MARGIN = 12
+STAMP_TOP_MARGIN = 47
+
+# Function to place the stamp on a page: returns (x, y, width, height) in PDF
+# points from the bottom left of the page
+def stamp_placement(stamp_size, page_width, page_height):
+    dpi_x, dpi_y = STAMP_DPI
+
+    # Convert pixel dimensions to points (72 points per inch)
+    width_points = stamp_size[0] / dpi_x * 72
+    height_points = stamp_size[1] / dpi_y * 72
+
+    x_position = page_width - width_points - STAMP_RIGHT_MARGIN
+    y_position = page_height - height_points - STAMP_TOP_MARGIN
+    return x_position, y_position, width_points, height_points
+
+# Function to fit a photo onto a landscape A4 page keeping its aspect ratio,
+# centred: returns (x, y, width, height) in PDF points from the bottom left
+def image_placement(image_width, image_height):
+    page_width, page_height = A4_LANDSCAPE
+
+    # Calculate aspect ratio
+    aspect_ratio = image_width / image_height
+    page_aspect_ratio = page_width / page_height
+
+    # Determine the dimensions for the image
+    if aspect_ratio > page_aspect_ratio:
+        # Image is wider than the page
+        scaled_width = page_width
+        scaled_height = page_width / aspect_ratio
+    else:
+        # Image is taller than the page
+        scaled_height = page_height
+        scaled_width = page_height * aspect_ratio
+
+    # Center the image on the page
+    x_position = (page_width - scaled_width) / 2
+    y_position = (page_height - scaled_height) / 2
+    return x_position, y_position, scaled_width, scaled_height
+
+def import_pymupdf():
+    try:
+        import pymupdf
+    except ImportError:
+        import fitz as pymupdf  # PyMuPDF before 1.24
+    return pymupdf
+
+def pymupdf_available():
+    try:
+        import_pymupdf()
+        return True
+    except ImportError:
+        return False
+
+def add_stamp_to_page_with_precise_dpi(page, stamp_image_path):
+    # Create a new PDF to hold the stamp
+    packet = BytesIO()
+    c = canvas.Canvas(packet, pagesize=page.mediabox.upper_right)
+    
+    # Load the stamp image
+    stamp_image = Image.open(stamp_image_path)
+    
+    # Ensure the image is in a compatible mode
+    if stamp_image.mode != 'RGBA':
+        stamp_image = stamp_image.convert('RGBA')
+    
+    # Get the dimensions of the page
+    page_width = float(page.mediabox.upper_right[0])
+    page_height = float(page.mediabox.upper_right[1])
+    
+    # Exact DPI of the reference stamp, at a fixed position for consistent placement
+    x_position, y_position, width_points, height_points = stamp_placement(stamp_image.size, page_width, page_height)
+    
+    # Draw the stamp with precise dimensions and transparency support
+    # (straight from memory so parallel workers don't share a temp file)
+    c.drawImage(ImageReader(stamp_image), x_position, y_position, width=width_points, height=height_points, mask='auto')
+    c.save()
+    
+    # Move to the beginning of the BytesIO buffer
+    packet.seek(0)
+    
+    # Create new PDF with the stamp
+    new_pdf = PdfReader(packet)
+    new_page = new_pdf.pages[0]
+    
+    # Merge the stamped page with the original
+    page.merge_page(new_page)
+    
+    return page
+
+# Unit rotation matrices (cos, sin) for the angles a page can be turned by
+ROTATIONS = {0: (1, 0), 90: (0, 1), 180: (-1, 0), 270: (0, -1)}
+
+def fit_page_to_landscape_a4(page, writer, rotate_portrait=False):
+    # Fit a page (already added to writer) onto landscape A4 in place: one
+    # scale/rotate/centre matrix is wrapped around the existing content stream
+    # and the page boxes are reset, so the drawing is neither copied nor re-parsed
+    page_width, page_height = landscape(A4)
+
+    box = page.cropbox
+    x0, y0 = float(box.left), float(box.bottom)
+    width, height = float(box.width), float(box.height)
+
+    # Bake the page's /Rotate (clockwise) into the matrix, optionally turning portrait sheets
+    rotation = int(page.get('/Rotate', 0) or 0) % 360
+    angle = -rotation
+    shown_width, shown_height = (width, height) if rotation % 180 == 0 else (height, width)
+    if rotate_portrait and shown_height > shown_width:
+        angle += 90
+    cos, sin = ROTATIONS[angle % 360]
+
+    corners = [(cos * x - sin * y, sin * x + cos * y) for x, y in ((0, 0), (width, 0), (0, height), (width, height))]
+    min_x = min(x for x, _ in corners)
+    min_y = min(y for _, y in corners)
+    rotated_width = max(x for x, _ in corners) - min_x
+    rotated_height = max(y for _, y in corners) - min_y
+
+    # Scale to fit and centre on the page
+    scale = min(page_width / rotated_width, page_height / rotated_height)
+    a, b, c, d = scale * cos, scale * sin, -scale * sin, scale * cos
+    e = -a * x0 - c * y0 - scale * min_x + (page_width - rotated_width * scale) / 2
+    f = -b * x0 - d * y0 - scale * min_y + (page_height - rotated_height * scale) / 2
+
+    # Clip to the original visible area, as the old blank-page merge did
+    prefix = DecodedStreamObject()
+    prefix.set_data(f"q {a:.6f} {b:.6f} {c:.6f} {d:.6f} {e:.4f} {f:.4f} cm {x0:.4f} {y0:.4f} {width:.4f} {height:.4f} re W n\n".encode())
+    suffix = DecodedStreamObject()
+    suffix.set_data(b"\nQ\n")
+
+    contents = page.raw_get('/Contents') if '/Contents' in page else ArrayObject()
+    if isinstance(contents, IndirectObject) and isinstance(contents.get_object(), ArrayObject):
+        contents = contents.get_object()
+    if not isinstance(contents, ArrayObject):
+        contents = [contents]
+    page[NameObject('/Contents')] = ArrayObject([writer._add_object(prefix), *contents, writer._add_object(suffix)])
+
+    page[NameObject('/MediaBox')] = RectangleObject([0, 0, page_width, page_height])
+    for box_name in ('/CropBox', '/TrimBox', '/BleedBox', '/ArtBox'):
+        if box_name in page:
+            del page[box_name]
+    page[NameObject('/Rotate')] = NumberObject(0)
+    return page
+
+def convert_to_landscape_a4(pdf_path, output_pdf, fit_to_page=False):
+    reader = PdfReader(pdf_path)
+    
+    for page in reader.pages:
+        if fit_to_page:
+            # Transform the original page rather than copying it onto a blank one
+            fit_page_to_landscape_a4(output_pdf.add_page(page), output_pdf)
+            continue
+
+        # Convert page to landscape A4
+        a4_landscape = landscape(A4)
+        new_page = PageObject.create_blank_page(width=a4_landscape[0], height=a4_landscape[1])
+        new_page.merge_page(page)
+        output_pdf.add_page(new_page)
+    
+    return output_pdf
+
+# Function to append one photo to a writer as a landscape A4 page, scaled to fit and centred
+def add_image_page(writer, image_path):
+    image_pdf = BytesIO()
+    c = canvas.Canvas(image_pdf, pagesize=landscape(A4))
+
+    # Adjust the position and size to fit the entire page
+    image = Image.open(image_path)
+    x_position, y_position, scaled_width, scaled_height = image_placement(*image.size)
+
+    # Draw the image on the canvas
+    c.drawImage(image_path, x_position, y_position, width=scaled_width, height=scaled_height)
+    c.save()
+
+    image_pdf.seek(0)
+    image_reader = PdfReader(image_pdf)
+    image_page = image_reader.pages[0]
+    writer.add_page(image_page)
+
+# The default PDF engine: pure-Python PyPDF2 plus reportlab
+class PyPDF2Engine:
+    name = 'pypdf2'
+
+    # Step 1: Add stamp to each page with the correct DPI, written to temp_path
+    def stamp(self, layout_pdf, stamp_image_path, temp_path):
+        reader = PdfReader(layout_pdf)
+        stamped_pdf_writer = PdfWriter()
+
+        for page in reader.pages:
+            stamped_page = add_stamp_to_page_with_precise_dpi(page, stamp_image_path)
+            stamped_pdf_writer.add_page(stamped_page)
+
+        with open(temp_path, 'wb') as temp_file:
+            stamped_pdf_writer.write(temp_file)
+        return temp_path
+
+    # Step 2: Convert the stamped PDF to landscape A4
+    def to_landscape_a4(self, stamped, fit_to_page=False):
+        converted_pdf_writer = PdfWriter()
+        convert_to_landscape_a4(stamped, converted_pdf_writer, fit_to_page)
+        return converted_pdf_writer
+
+    # Step 3: Append an image page
+    def add_image_page(self, document, image_path):
+        add_image_page(document, image_path)
+
+    # Write the final output PDF (compressed and de-duplicated in optimise mode);
+    # returns something with .pages for the combined batch PDF
+    def write(self, document, output_pdf_path, optimise=False):
+        write_pdf(document, output_pdf_path, optimise)
+        return document
+
+# A finished output file, only parsed if its pages are asked for (by the combined PDF,
+# which then costs a second read of the file; run.py warns when that happens)
+class WrittenPdf:
+    def __init__(self, pdf_path):
+        self.pdf_path = pdf_path
+
+    @property
+    def pages(self):
+        from PyPDF2 import PdfReader
+        return PdfReader(self.pdf_path).pages
+
+class PyMuPDFEngine:
+    name = 'pymupdf'
+
+    def __init__(self):
+        self.pymupdf = import_pymupdf()
+        self.stamps = {}  # stamp image path -> (PNG bytes, pixel size)
+
+    # The stamp as RGBA PNG bytes, converted once per process
+    def load_stamp(self, stamp_image_path):
+        if stamp_image_path not in self.stamps:
+            from io import BytesIO
+            from PIL import Image
+
+            stamp_image = Image.open(stamp_image_path)
+            if stamp_image.mode != 'RGBA':
+                stamp_image = stamp_image.convert('RGBA')
+            buffer = BytesIO()
+            stamp_image.save(buffer, format='PNG')
+            self.stamps[stamp_image_path] = (buffer.getvalue(), stamp_image.size)
+        return self.stamps[stamp_image_path]
+
+    # Convert an (x, y, width, height) box in PDF points to a MuPDF rect on page
+    def pdf_box_to_rect(self, page, x, y, width, height):
+        rect = self.pymupdf.Rect(x, y, x + width, y + height) * page.transformation_matrix
+        return rect.normalize()
+
+    def stamp(self, layout_pdf, stamp_image_path, temp_path):
+        document = self.pymupdf.open(layout_pdf)
+        stamp_png, stamp_size = self.load_stamp(stamp_image_path)
+
+        stamp_xref = 0
+        for page in document:
+            # Same reference point as the PyPDF2 engine: the upper right of the MediaBox
+            mediabox = page.mediabox
+            page_width = mediabox.x1
+            page_height = mediabox.y1
+            x, y, width, height = stamp_placement(stamp_size, page_width, page_height)
+            rect = self.pdf_box_to_rect(page, x, y, width, height)
+
+            # Embed the image once and refer to it from every page; like the merged
+            # reportlab overlay it is drawn in unrotated page space whatever the /Rotate
+            if stamp_xref:
+                page.insert_image(rect, xref=stamp_xref, keep_proportion=False)
+            else:
+                stamp_xref = page.insert_image(rect, stream=stamp_png, keep_proportion=False)
+        return document
+
+    def to_landscape_a4(self, stamped, fit_to_page=False):
+        output = self.pymupdf.open()
+        page_width, page_height = A4_LANDSCAPE
+
+        for source_page in stamped:
+            page = output.new_page(width=page_width, height=page_height)
+
+            # MuPDF clips a rotated source page to its rotated outline, which cuts
+            # off the stamp, so place it unrotated and turn it explicitly instead
+            rotation = source_page.rotation
+            source_page.set_rotation(0)
+
+            if fit_to_page:
+                # Scaled to fit and centred, showing the sheet the way /Rotate
+                # (clockwise) turns it; show_pdf_page turns counter-clockwise
+                page.show_pdf_page(page.rect, stamped, source_page.number, rotate=-rotation)
+            else:
+                # Unscaled from the bottom left corner, ignoring /Rotate, and cropped
+                # to the page, as merging onto a blank landscape A4 page does
+                source = source_page.cropbox
+                target = self.pymupdf.Rect(source.x0, page_height - source.y1, source.x1, page_height - source.y0)
+                page.show_pdf_page(target, stamped, source_page.number)
+
+        stamped.close()
+        return output
+
+    def add_image_page(self, document, image_path):
+        from PIL import Image
+
+        page_width, page_height = A4_LANDSCAPE
+        page = document.new_page(width=page_width, height=page_height)
+
+        with Image.open(image_path) as image:
+            x, y, width, height = image_placement(*image.size)
+        rect = self.pymupdf.Rect(x, page_height - y - height, x + width, page_height - y)
+        page.insert_image(rect, filename=image_path, keep_proportion=False)
+
+    def write(self, document, output_pdf_path, optimise=False):
+        # The plain save is also the "before" size in optimise mode; it goes to disk
+        # rather than memory so a large document isn't held twice
+        document.save(output_pdf_path, garbage=1, deflate=True)
+        if optimise:
+            size_before = os.path.getsize(output_pdf_path)
+            temp_path = output_pdf_path + '.tmp'
+            document.save(temp_path, garbage=4, deflate=True, clean=True, use_objstms=1)
+            os.replace(temp_path, output_pdf_path)
+
+            size_after = os.path.getsize(output_pdf_path)
+            saved = 100 * (1 - size_after / size_before) if size_before else 0
+            print(f"Optimised {os.path.basename(output_pdf_path)}: {size_before:,} -> {size_after:,} bytes ({saved:.1f}% smaller)")
+        document.close()
+        return WrittenPdf(output_pdf_path)
+
+engines = {}  # name -> engine instance, one per process
+
+# Function to get an engine by name (None means the default); engine objects are passed through
+def get_engine(engine=None):
+    if engine is not None and not isinstance(engine, str):
+        return engine
+
+    name = engine or 'pypdf2'
+    if name == 'auto':
+        name = 'pymupdf' if pymupdf_available() else 'pypdf2'
+
+    if name not in engines:
+        if name == 'pypdf2':
+            engines[name] = PyPDF2Engine()
+        elif name == 'pymupdf':
+            engines[name] = PyMuPDFEngine()
+        else:
+            raise ValueError(f"Unknown PDF engine: {name} (choose from {', '.join(ENGINE_NAMES)})")
+    return engines[name]
@@ -0,0 +1,161 @@
+import hashlib
+import os
+from io import BytesIO
+from PyPDF2.generic import ArrayObject, DictionaryObject, IndirectObject, NameObject, NullObject, StreamObject
+
+# Size optimisation for the PdfWriter output of run.py. Content streams are
+# Flate-compressed, identical objects (the stamp image repeated on every sheet,
+# fonts embedded once per page by merge_page) are collapsed into one, and
+# objects nothing refers to any more are dropped. If pikepdf is installed the
+# file is then re-saved with object and xref streams, which PyPDF2 can't write.
+
+# Dictionary types that are safe to share between pages when identical
+SHAREABLE_TYPES = {'/Font', '/FontDescriptor', '/ExtGState', '/XObject'}
+
+# Stream-like sink that only counts bytes, to size a PDF without keeping it
+class ByteCounter:
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.size
+
+# Function to get the size a writer would produce without writing a file
+def measure_pdf_size(writer):
+    counter = ByteCounter()
+    writer.write(counter)
+    return counter.size
+
+# Function to point every reference in obj at its replacement object number
+def replace_references(obj, replacements, writer):
+    if isinstance(obj, DictionaryObject):
+        entries = list(obj.items())
+    elif isinstance(obj, ArrayObject):
+        entries = list(enumerate(obj))
+    else:
+        return
+
+    for key, value in entries:
+        if isinstance(value, IndirectObject):
+            if value.pdf is writer and value.idnum in replacements:
+                obj[key] = IndirectObject(replacements[value.idnum], 0, writer)
+        else:
+            replace_references(value, replacements, writer)
+
+# Function to collapse byte-identical streams and shareable dictionaries.
+# Repeats until nothing changes, since merging e.g. two images can make the
+# dictionaries that refer to them identical too. Returns the number removed.
+def remove_duplicate_objects(writer, max_passes=5):
+    removed = 0
+
+    for _ in range(max_passes):
+        seen = {}
+        replacements = {}
+
+        for index, obj in enumerate(writer._objects):
+            if isinstance(obj, StreamObject):
+                pass
+            elif isinstance(obj, DictionaryObject) and obj.get('/Type') in SHAREABLE_TYPES:
+                pass
+            else:
+                continue
+
+            buffer = BytesIO()
+            obj.write_to_stream(buffer, None)
+            digest = hashlib.sha1(buffer.getvalue()).digest()
+
+            idnum = index + 1
+            if digest in seen:
+                replacements[idnum] = seen[digest]
+            else:
+                seen[digest] = idnum
+
+        if not replacements:
+            break
+
+        for obj in writer._objects:
+            replace_references(obj, replacements, writer)
+
+        # PyPDF2 numbers objects by position, so emptied slots must stay in place
+        for idnum in replacements:
+            writer._objects[idnum - 1] = NullObject()
+        removed += len(replacements)
+
+    return removed
+
+# Function to drop objects that can no longer be reached from the document
+# root or info dictionary (e.g. the uncompressed content streams replaced by
+# compress_content_streams). Returns the number removed.
+def remove_unreachable_objects(writer):
+    reachable = set()
+    stack = [writer._root_object, writer._info]
+
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, IndirectObject):
+            if obj.pdf is not writer or obj.idnum in reachable:
+                continue
+            reachable.add(obj.idnum)
+            stack.append(writer._objects[obj.idnum - 1])
+        elif isinstance(obj, DictionaryObject):
+            stack.extend(obj.values())
+        elif isinstance(obj, ArrayObject):
+            stack.extend(obj)
+
+    removed = 0
+    for index, obj in enumerate(writer._objects):
+        if index + 1 in reachable or obj is writer._root_object or isinstance(obj, NullObject):
+            continue
+        writer._objects[index] = NullObject()
+        removed += 1
+
+    return removed
+
+# Function to compress and de-duplicate everything a writer holds
+def optimise_pdf_writer(writer):
+    for page in writer.pages:
+        if '/Contents' not in page:
+            continue
+        page.compress_content_streams()
+        # PyPDF2 leaves the compressed stream inline, but streams must be indirect objects
+        page[NameObject('/Contents')] = writer._add_object(page['/Contents'])
+
+    remove_duplicate_objects(writer)
+    remove_unreachable_objects(writer)
+
+# Function to re-save a finished PDF with object/xref streams when pikepdf is available
+def save_with_object_streams(pdf_path):
+    try:
+        import pikepdf
+    except ImportError:
+        return False
+
+    temp_path = pdf_path + '.tmp'
+    with pikepdf.open(pdf_path) as pdf:
+        pdf.save(temp_path, compress_streams=True, object_stream_mode=pikepdf.ObjectStreamMode.generate)
+    os.replace(temp_path, pdf_path)
+    return True
+
+# Function to write a PdfWriter to output_pdf_path, optionally optimising it first.
+# In optimise mode returns (bytes before, bytes after) and prints the saving.
+def write_pdf(writer, output_pdf_path, optimise=False):
+    if not optimise:
+        with open(output_pdf_path, 'wb') as output_file:
+            writer.write(output_file)
+        return None
+
+    size_before = measure_pdf_size(writer)
+    optimise_pdf_writer(writer)
+
+    with open(output_pdf_path, 'wb') as output_file:
+        writer.write(output_file)
+    save_with_object_streams(output_pdf_path)
+
+    size_after = os.path.getsize(output_pdf_path)
+    saved = 100 * (1 - size_after / size_before) if size_before else 0
+    print(f"Optimised {os.path.basename(output_pdf_path)}: {size_before:,} -> {size_after:,} bytes ({saved:.1f}% smaller)")
+    return size_before, size_after
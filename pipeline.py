@@ -0,0 +1,151 @@
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from driveService import get_drive_service
+from downloadUtils import SharedDownloads, download_key
+from downloadPDF import person_folder_name, plan_layout_links, download_layouts_for_row, save_failed_downloads_to_csv
+from downloadAllFiles import extract_id, download_images_for_row, add_photo_size_arguments, photo_size_from_args
+from run import find_layout_and_images, endorsed_output_path
+from downloadTelemetry import telemetry, add_telemetry_arguments, configure_from_args
+from pdfEngines import ENGINE_NAMES
+from memoryScheduler import MemoryScheduler, add_memory_arguments, memory_limits_from_args
+
+# Combined download + endorsement run. Download workers (threads, network
+# bound) fetch each person's layout PDF and photos; as soon as a person's
+# folder is complete it is queued for stamping on a process pool (CPU bound),
+# so stamping overlaps with the downloads still in flight. Stamping jobs are
+# scheduled against a memory budget (see memoryScheduler).
+
+# Function to download everything for one row into its person folder
+# Returns (person_folder, [(No, Name, link/file, error), ...])
+def download_row(row, batch_folder, shared, photo_size=None):
+    # Each download thread gets its own Drive service
+    service = get_drive_service()
+
+    person_folder = os.path.join(batch_folder, person_folder_name(row['No'], row['Name']))
+    failures = []
+
+    # Layout PDF(s)
+    _, _, layout_failures = download_layouts_for_row(service, plan_layout_links(row['Layout Link']), person_folder, shared)
+    for link, error in layout_failures:
+        failures.append((row['No'], row['Name'], link, error))
+
+    # Photos
+    gdrive_link = row['G.Drive Link']
+    gdrive_id, gdrive_type = extract_id(gdrive_link) if isinstance(gdrive_link, str) else (None, None)
+    if gdrive_id is None:
+        failures.append((row['No'], row['Name'], gdrive_link, "Invalid Google Drive link"))
+    else:
+        _, image_failures = download_images_for_row(service, gdrive_id, gdrive_type, download_key(gdrive_link, gdrive_id),
+                                                     row['Name'], person_folder, shared, photo_size)
+        for _, file_name, error in image_failures:
+            failures.append((row['No'], row['Name'], file_name, error))
+
+    return person_folder, failures
+
+def run_pipeline(excel_path, batch_folder, output_folder, stamp_image_path, download_workers=4, stamp_workers=None, engine=None,
+                 photo_size=None, memory_budget=None, max_image_pixels=None):
+    import pandas as pd
+
+    df = pd.read_excel(excel_path)
+    os.makedirs(batch_folder, exist_ok=True)
+    os.makedirs(output_folder, exist_ok=True)
+
+    # Authenticate once up front so a login prompt doesn't happen inside a worker
+    get_drive_service()
+
+    shared = SharedDownloads()
+    failed_downloads = []
+    no_output_folders = []
+    incomplete_folders = []  # person folders not stamped because some of their downloads failed
+    failed_stamps = []
+    endorsed = 0
+
+    print(f"Starting pipeline for {len(df)} entries...\n")
+
+    with ThreadPoolExecutor(max_workers=download_workers) as download_pool, \
+            MemoryScheduler(stamp_workers, memory_budget, max_image_pixels) as stamp_scheduler:
+        download_futures = {download_pool.submit(download_row, row, batch_folder, shared, photo_size): row for _, row in df.iterrows()}
+        stamp_futures = {}
+
+        # Queue each person folder for stamping as soon as its downloads finish
+        for future in as_completed(download_futures):
+            row = download_futures[future]
+            try:
+                person_folder, failures = future.result()
+            except Exception as e:
+                # One bad row (e.g. an unexpected Drive error) mustn't stop the rest of the batch
+                print(f"Failed to download row {row['No']} ({row['Name']}): {e}")
+                failed_downloads.append((row['No'], row['Name'], row['Layout Link'], str(e)))
+                incomplete_folders.append(person_folder_name(row['No'], row['Name']))
+                continue
+            failed_downloads.extend(failures)
+            if failures:
+                # Stamping now would give a complete-looking PDF that is missing photos or has no/stale layout
+                incomplete_folders.append(os.path.basename(person_folder))
+                continue
+
+            layout_pdf, image_files = find_layout_and_images(person_folder)
+            if layout_pdf and image_files:
+                output_pdf_path = endorsed_output_path(layout_pdf, output_folder)
+                stamp_future = stamp_scheduler.submit(layout_pdf, image_files, stamp_image_path, output_pdf_path, engine=engine)
+                stamp_futures[stamp_future] = layout_pdf
+            else:
+                no_output_folders.append(os.path.basename(person_folder))
+
+        for stamp_future in as_completed(stamp_futures):
+            layout_pdf = stamp_futures[stamp_future]
+            try:
+                stamp_future.result()
+                endorsed += 1
+                print(f"Processed {layout_pdf}")
+            except Exception as e:
+                failed_stamps.append((layout_pdf, str(e)))
+
+    # Print summary
+    print(f"\n" + "="*50)
+    print("PIPELINE SUMMARY")
+    print("="*50)
+    print(f"Endorsed PDFs written: {endorsed}")
+    print(f"Failed downloads: {len(failed_downloads)}")
+    print(f"Failed endorsements: {len(failed_stamps)}")
+    print(shared.summary())
+
+    if incomplete_folders:
+        print("\nSubfolders not endorsed because downloads failed (see the failed downloads CSV):")
+        for folder in incomplete_folders:
+            print(folder)
+
+    if no_output_folders:
+        print("\nSubfolders with no output:")
+        for folder in no_output_folders:
+            print(folder)
+
+    for layout_pdf, error in failed_stamps:
+        print(f"Failed to endorse {layout_pdf}: {error}")
+
+    save_failed_downloads_to_csv(failed_downloads)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download a batch and endorse each person folder as soon as it is ready")
+    parser.add_argument("excel_path", help="Batch spreadsheet (No, Name, Layout Link, G.Drive Link)")
+    parser.add_argument("batch_folder", help="Folder the person folders are downloaded into")
+    parser.add_argument("output_folder", help="Folder for the endorsed PDFs")
+    parser.add_argument("stamp_image_path", help="Stamp image to apply")
+    parser.add_argument("--download-workers", type=int, default=4)
+    parser.add_argument("--stamp-workers", type=int, default=None, help="Defaults to the number of CPUs")
+    parser.add_argument("--engine", choices=ENGINE_NAMES, default="pypdf2", help="PDF engine (see pdfEngines)")
+    add_telemetry_arguments(parser)
+    add_photo_size_arguments(parser)
+    add_memory_arguments(parser)
+    args = parser.parse_args()
+    memory_budget, max_image_pixels = memory_limits_from_args(args)
+
+    configure_from_args(args)
+    try:
+        run_pipeline(args.excel_path, args.batch_folder, args.output_folder, args.stamp_image_path,
+                     args.download_workers, args.stamp_workers, args.engine, photo_size_from_args(args),
+                     memory_budget, max_image_pixels)
+    finally:
+        telemetry.close()
@@ -1,176 +1,231 @@
 import os
+import re
 import shutil
 import subprocess
 import sys
-from PyPDF2 import PdfReader, PdfWriter, PageObject
-from PIL import Image
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import landscape, A4
-from io import BytesIO
-import time
-
-def add_stamp_to_page_with_precise_dpi(page, stamp_image_path):
-    # Create a new PDF to hold the stamp
-    packet = BytesIO()
-    c = canvas.Canvas(packet, pagesize=page.mediabox.upper_right)
-    
-    # Load the stamp image
-    stamp_image = Image.open(stamp_image_path)
-    
-    # Ensure the image is in a compatible mode
-    if stamp_image.mode != 'RGBA':
-        stamp_image = stamp_image.convert('RGBA')
-    
-    # Set the exact DPI values from the reference stamp
-    dpi_x, dpi_y = 295, 301
-    
-    # Convert pixel dimensions to points (72 points per inch)
-    width_inches = stamp_image.size[0] / dpi_x
-    height_inches = stamp_image.size[1] / dpi_y
-    
-    # Convert to points (1 inch = 72 points)
-    width_points = width_inches * 72
-    height_points = height_inches * 72
-    
-    # Get the dimensions of the page
-    page_width = float(page.mediabox.upper_right[0])
-    page_height = float(page.mediabox.upper_right[1])
-    
-    # Fixed position for consistent placement
-    x_position = page_width - width_points - 12
-    y_position = page_height - height_points - 47
-    
-    # Save the stamp image temporarily in PNG format
-    temp_stamp_path = f"temp_stamp_{int(time.time() * 1000)}.png"
-    stamp_image.save(temp_stamp_path, format='PNG')
-    
-    # Draw the stamp with precise dimensions and transparency support
-    c.drawImage(temp_stamp_path, x_position, y_position, width=width_points, height=height_points, mask='auto')
-    c.save()
-    
-    # Clean up temporary file
-    os.remove(temp_stamp_path)
-    
-    # Move to the beginning of the BytesIO buffer
-    packet.seek(0)
-    
-    # Create new PDF with the stamp
-    new_pdf = PdfReader(packet)
-    new_page = new_pdf.pages[0]
-    
-    # Merge the stamped page with the original
-    page.merge_page(new_page)
-    
-    return page
+from collections import namedtuple
+from concurrent.futures import wait
+from pdfEngines import ENGINE_NAMES, get_engine
+from memoryScheduler import MemoryScheduler, ImageTooLargeError, check_image_sizes
 
-def convert_to_landscape_a4(pdf_path, output_pdf):
-    reader = PdfReader(pdf_path)
-    
-    for page in reader.pages:
-        # Convert page to landscape A4
-        a4_landscape = landscape(A4)
-        new_page = PageObject.create_blank_page(width=a4_landscape[0], height=a4_landscape[1])
-        new_page.merge_page(page)
-        output_pdf.add_page(new_page)
-    
-    return output_pdf
+def process_pdf_with_stamp_and_images(layout_pdf, image_files, stamp_image_path, output_pdf_path, optimise=False, fit_to_page=False,
+                                      engine=None):
+    engine = get_engine(engine)
 
-def process_pdf_with_stamp_and_images(layout_pdf, image_files, stamp_image_path, output_pdf_path):
-    # Step 1: Add stamp to each page with the correct DPI
-    reader = PdfReader(layout_pdf)
-    stamped_pdf_writer = PdfWriter()
+    # Engines that can't stamp in memory write the stamped PDF next to the layout
+    temp_stamped_pdf_path = os.path.splitext(layout_pdf)[0] + "_stamped.pdf"
+    stamped = engine.stamp(layout_pdf, stamp_image_path, temp_stamped_pdf_path)
 
-    for page in reader.pages:
-        stamped_page = add_stamp_to_page_with_precise_dpi(page, stamp_image_path)
-        stamped_pdf_writer.add_page(stamped_page)
-    
-    # Write the stamped PDF to a temporary file
-    temp_stamped_pdf_path = layout_pdf.replace(".pdf", "_stamped.pdf")
-    with open(temp_stamped_pdf_path, 'wb') as temp_file:
-        stamped_pdf_writer.write(temp_file)
+    document = engine.to_landscape_a4(stamped, fit_to_page)
+    for image_path in image_files:
+        engine.add_image_page(document, image_path)
 
-    # Step 2: Convert the stamped PDF to landscape A4
-    converted_pdf_writer = PdfWriter()
-    convert_to_landscape_a4(temp_stamped_pdf_path, converted_pdf_writer)
+    endorsed = engine.write(document, output_pdf_path, optimise)
 
-    # Step 3: Append images to the converted PDF
-    for image_path in image_files:
-        image_pdf_path = "image.pdf"
-        c = canvas.Canvas(image_pdf_path, pagesize=landscape(A4))
-
-        # Adjust the position and size to fit the entire page
-        image = Image.open(image_path)
-        image_width, image_height = image.size
-        page_width, page_height = landscape(A4)
-
-        # Calculate aspect ratio
-        aspect_ratio = image_width / image_height
-        page_aspect_ratio = page_width / page_height
-
-        # Determine the dimensions for the image
-        if aspect_ratio > page_aspect_ratio:
-            # Image is wider than the page
-            scaled_width = page_width
-            scaled_height = page_width / aspect_ratio
-        else:
-            # Image is taller than the page
-            scaled_height = page_height
-            scaled_width = page_height * aspect_ratio
+    # Clean up temporary files
+    if os.path.exists(temp_stamped_pdf_path):
+        os.remove(temp_stamped_pdf_path)
 
-        # Center the image on the page
-        x_position = (page_width - scaled_width) / 2
-        y_position = (page_height - scaled_height) / 2
+    return endorsed
 
-        # Draw the image on the canvas
-        c.drawImage(image_path, x_position, y_position, width=scaled_width, height=scaled_height)
-        c.save()
+# One person folder in a batch: No_ prefix (None if the folder has none), folder
+# name and path, and its layout PDFs and images in sorted order
+BatchFolder = namedtuple('BatchFolder', ['no', 'name', 'path', 'layout_pdfs', 'image_files'])
 
-        image_reader = PdfReader(image_pdf_path)
-        image_page = image_reader.pages[0]
-        converted_pdf_writer.add_page(image_page)
-        os.remove(image_pdf_path)
+def scan_person_folder(subfolder_path):
+    layout_pdfs = []
+    image_files = []
 
-    # Write the final output PDF
-    with open(output_pdf_path, 'wb') as output_file:
-        converted_pdf_writer.write(output_file)
+    with os.scandir(subfolder_path) as entries:
+        for entry in entries:
+            file_name = entry.name.lower()
+            # Skip the temporary copy process_pdf_with_stamp_and_images writes next to the layout
+            if file_name.endswith("_stamped.pdf") or not entry.is_file():
+                continue
+            if file_name.endswith(".pdf"):
+                layout_pdfs.append(entry.path)
+            elif file_name.endswith((".png", ".jpg", ".jpeg")):
+                image_files.append(entry.path)
 
-    # Clean up temporary files
-    os.remove(temp_stamped_pdf_path)
+    # Sort by filename so the layout picked and the image order never depend on listing order
+    layout_pdfs.sort()
+    image_files.sort()
+    return layout_pdfs, image_files
+
+def find_layout_and_images(subfolder_path):
+    layout_pdfs, image_files = scan_person_folder(subfolder_path)
+    layout_pdf = layout_pdfs[0] if layout_pdfs else None
+    return layout_pdf, image_files
+
+def folder_number(folder_name):
+    match = re.match(r"(\d+)_", folder_name)
+    return int(match.group(1)) if match else None
 
-def process_all_subfolders(batch_folder, output_folder, stamp_image_path):
+# Function to index a batch folder in one pass, ordered by the No_ prefix
+# (folders without a prefix come last, by name). With only_rows, other folders
+# are left out before their contents are listed.
+def build_batch_index(batch_folder, only_rows=None):
+    index = []
+    with os.scandir(batch_folder) as entries:
+        for entry in entries:
+            # Dot folders hold bookkeeping such as shard claims, not people
+            if not entry.is_dir() or entry.name.startswith('.'):
+                continue
+            if only_rows is not None and folder_number(entry.name) not in only_rows:
+                continue
+            layout_pdfs, image_files = scan_person_folder(entry.path)
+            index.append(BatchFolder(folder_number(entry.name), entry.name, entry.path, layout_pdfs, image_files))
+
+    index.sort(key=lambda folder: (folder.no is None, folder.no or 0, folder.name))
+    return index
+
+# Function to parse a row selector such as "12,15,40-45" into a set of row numbers
+def parse_row_selection(selection):
+    rows = set()
+    for part in selection.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-', 1)
+            start, end = int(start), int(end)
+            if start > end:
+                raise ValueError(f"Invalid row range: {part}")
+            rows.update(range(start, end + 1))
+        else:
+            rows.add(int(part))
+    return rows
+
+# The person folder is part of the name: one layout PDF can be shared by several
+# rows (each person folder gets a copy), and they must not write the same file
+def endorsed_output_path(layout_pdf, output_folder):
+    person_folder = os.path.basename(os.path.dirname(os.path.abspath(layout_pdf)))
+    base_name = os.path.splitext(os.path.basename(layout_pdf))[0]
+    endorsed_pdf_name = f"{person_folder} - {base_name} - Endorsed.pdf"
+    return os.path.join(output_folder, endorsed_pdf_name)
+
+def process_all_subfolders(batch_folder, output_folder, stamp_image_path, optimise=False, combined_pdf_path=None, fit_to_page=False,
+                           only_rows=None, sharding=None, engine=None, workers=None, memory_budget=None, max_image_pixels=None):
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
     
     no_output_folders = []  # List to store subfolders with no output
+    refused_folders = []    # (subfolder, reason) for photos too large to open safely
+    failed_folders = []     # (subfolder, error) in parallel mode
+
+    # Optional single PDF for the whole batch, built alongside the per-person files
+    combined = None
+    if combined_pdf_path:
+        from combinedPdf import CombinedPdfWriter
+        combined = CombinedPdfWriter(combined_pdf_path)
+
+    batch_index = build_batch_index(batch_folder, only_rows)
+    if only_rows is not None:
+        missing_rows = sorted(only_rows - {folder.no for folder in batch_index})
+        if missing_rows:
+            print(f"No folders found for rows: {', '.join(str(row) for row in missing_rows)}")
+
+    # When the batch is shared with other machines only take this node's folders,
+    # and keep going past failures so one bad folder doesn't stall the others
+    work = batch_index
+    if sharding:
+        work = sharding.select([(folder.name, folder.no, folder) for folder in batch_index])
+
+    # With several workers, folders are endorsed in parallel processes, scheduled
+    # against a memory budget (see memoryScheduler); results are handled as they finish
+    scheduler = MemoryScheduler(workers, memory_budget, max_image_pixels) if workers and workers > 1 else None
+
+    # Only the PyPDF2 engine in this process hands its pages straight to the combined PDF;
+    # otherwise every endorsed PDF is read back from disk afterwards
+    if combined and (scheduler or get_engine(engine).name != 'pypdf2'):
+        print("Note: with --workers or the pymupdf engine the combined PDF is built in a second pass "
+              "that re-reads every endorsed PDF (use --engine pypdf2 without --workers to avoid it)")
+    endorsed_outputs = {}  # subfolder -> endorsed PDF, for the combined PDF in parallel mode
+    futures = []
+
+    def job_finished(subfolder_name, layout_pdf, future):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if isinstance(error, ImageTooLargeError):
+            refused_folders.append((subfolder_name, str(error)))
+            status = 'refused'
+        elif error is not None:
+            print(f"Failed to endorse {layout_pdf}: {error}")
+            failed_folders.append((subfolder_name, str(error)))
+            status = 'failed'
+        else:
+            endorsed_outputs[subfolder_name] = future.result()
+            print(f"Processed {layout_pdf}")
+            status = 'ok'
+        if sharding:
+            sharding.release(subfolder_name, status, endorsed_outputs.get(subfolder_name, ''), str(error or ''))
 
-    for subfolder_name in os.listdir(batch_folder):
-        subfolder_path = os.path.join(batch_folder, subfolder_name)
-        if os.path.isdir(subfolder_path):
-            layout_pdf = None
-            image_files = []
+    for folder in work:
+        subfolder_name = folder.name
+        if len(folder.layout_pdfs) > 1:
+            print(f"Warning: {subfolder_name} has {len(folder.layout_pdfs)} layout PDFs, using {os.path.basename(folder.layout_pdfs[0])}")
+
+        layout_pdf = folder.layout_pdfs[0] if folder.layout_pdfs else None
+        image_files = folder.image_files
+
+        if layout_pdf and image_files:
+            output_pdf_path = endorsed_output_path(layout_pdf, output_folder)
+
+            if scheduler:
+                future = scheduler.submit(layout_pdf, image_files, stamp_image_path, output_pdf_path, optimise, fit_to_page, engine)
+                future.add_done_callback(lambda done, name=subfolder_name, pdf=layout_pdf: job_finished(name, pdf, done))
+                futures.append(future)
+                # Claims are taken as the loop asks for the next folder, so only ask
+                # once this one has started; otherwise this node claims the whole batch
+                if sharding and sharding.mode == 'claim':
+                    scheduler.wait_for_free_worker()
+                continue
             
-            for file_name in os.listdir(subfolder_path):
-                file_path = os.path.join(subfolder_path, file_name)
-                if file_name.lower().endswith(".pdf"):
-                    layout_pdf = file_path
-                elif file_name.lower().endswith((".png", ".jpg", ".jpeg")):
-                    image_files.append(file_path)
+            # Process PDF with stamp and images
+            try:
+                check_image_sizes(image_files, max_image_pixels)
+                endorsed_writer = process_pdf_with_stamp_and_images(layout_pdf, image_files, stamp_image_path, output_pdf_path,
+                                                                    optimise, fit_to_page, engine)
+            except ImageTooLargeError as e:
+                refused_folders.append((subfolder_name, str(e)))
+                if sharding:
+                    sharding.release(subfolder_name, 'refused', error=str(e))
+                continue
+            except Exception as e:
+                if not sharding:
+                    raise
+                print(f"Failed to endorse {layout_pdf}: {e}")
+                sharding.release(subfolder_name, 'failed', error=str(e))
+                continue
+            if combined:
+                combined.add_document(endorsed_writer.pages, subfolder_name)
             
-            if layout_pdf and image_files:
-                # Sort images by filename
-                image_files.sort()
-
-                base_name = os.path.splitext(os.path.basename(layout_pdf))[0]
-                endorsed_pdf_name = f"{base_name} - Endorsed.pdf"
-                output_pdf_path = os.path.join(output_folder, endorsed_pdf_name)
-                
-                # Process PDF with stamp and images
-                process_pdf_with_stamp_and_images(layout_pdf, image_files, stamp_image_path, output_pdf_path)
-                
-                print(f"Processed {layout_pdf}")
-            else:
-                # If no PDF or no images, add the subfolder to the no_output_folders list
-                no_output_folders.append(subfolder_name)
+            print(f"Processed {layout_pdf}")
+            if sharding:
+                sharding.release(subfolder_name, 'ok', output_pdf_path)
+        else:
+            # If no PDF or no images, add the subfolder to the no_output_folders list
+            no_output_folders.append(subfolder_name)
+            if sharding:
+                sharding.release(subfolder_name, 'no output')
+
+    if scheduler:
+        wait(futures)
+        scheduler.shutdown()
+
+        # Add to the combined PDF in batch order once everything is written
+        if combined:
+            from pdfEngines import WrittenPdf
+            for folder in batch_index:
+                if folder.name in endorsed_outputs:
+                    combined.add_document(WrittenPdf(endorsed_outputs[folder.name]).pages, folder.name)
+
+    if combined:
+        combined.close()
+
+    if sharding:
+        sharding.write_summary([folder.name for folder in batch_index])
 
     # Print folders with no output at the end
     if no_output_folders:
@@ -178,10 +233,55 @@ def process_all_subfolders(batch_folder, output_folder, stamp_image_path):
         for folder in no_output_folders:
             print(folder)
 
+    if refused_folders:
+        print("\nSubfolders refused (photos too large to open safely):")
+        for folder, reason in refused_folders:
+            print(f"{folder}: {reason}")
+
+    if failed_folders:
+        print("\nSubfolders that failed:")
+        for folder, error in failed_folders:
+            print(f"{folder}: {error}")
+
 # Example usage
 if __name__ == "__main__":
-    batch_folder = r'C:\Users\nb1633\Documents\Batch 76'
-    output_folder = r'C:\Users\nb1633\Documents\Batch 76 Endorsed'
-    stamp_image_path = r'C:\Users\nb1633\Documents\newStamp.png'
+    import argparse
+    from shardWork import add_shard_arguments, sharding_from_args
+    from memoryScheduler import add_memory_arguments, memory_limits_from_args
+
+    parser = argparse.ArgumentParser(description="Stamp layout PDFs and append site photos for every person folder in a batch")
+    parser.add_argument("batch_folder", nargs="?", default=r'C:\Users\nb1633\Documents\Batch 76',
+                        help="Batch folder (with --watch: a root folder holding batch folders)")
+    parser.add_argument("output_folder", nargs="?", default=r'C:\Users\nb1633\Documents\Batch 76 Endorsed',
+                        help="Output folder (with --watch: root for the '<batch> Endorsed' folders)")
+    parser.add_argument("--stamp", dest="stamp_image_path", default=r'C:\Users\nb1633\Documents\newStamp.png')
+    parser.add_argument("--optimise", action="store_true", help="Shrink the endorsed PDFs (compress + de-duplicate)")
+    parser.add_argument("--fit", action="store_true", help="Scale and centre each sheet onto landscape A4 instead of cropping it")
+    parser.add_argument("--combined", metavar="PDF", help="Also write one combined PDF for the batch with a bookmark per person")
+    parser.add_argument("--only", metavar="ROWS",
+                        help="Only re-endorse these rows by No_ prefix, e.g. 12,15,40-45 (add --reset when sharding)")
+    parser.add_argument("--watch", action="store_true", help="Keep running and endorse person folders as they are filled")
+    parser.add_argument("--settle", type=float, default=30, help="Seconds a folder must be unchanged before it is endorsed (--watch)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Parallel endorsements, scheduled within --memory-budget (default: one at a time, CPU count in --watch mode)")
+    parser.add_argument("--engine", choices=ENGINE_NAMES, default="pypdf2",
+                        help="PDF engine: pypdf2 (default), pymupdf (needs PyMuPDF) or auto (pymupdf when installed)")
+    add_shard_arguments(parser)
+    add_memory_arguments(parser)
+    args = parser.parse_args()
+    memory_budget, max_image_pixels = memory_limits_from_args(args)
 
-    process_all_subfolders(batch_folder, output_folder, stamp_image_path)
+    if args.watch:
+        from watchFolder import watch_batch_root
+        watch_batch_root(args.batch_folder, args.output_folder, args.stamp_image_path,
+                         args.settle, args.workers, args.optimise, args.fit, args.engine, memory_budget, max_image_pixels)
+    else:
+        try:
+            only_rows = parse_row_selection(args.only) if args.only else None
+        except ValueError as e:
+            parser.error(f"--only: {e} (expected rows like 12,15,40-45)")
+        sharding = sharding_from_args(args, args.batch_folder, 'endorse')
+        if sharding and args.combined:
+            parser.error("--combined needs the whole batch on one machine; it can't be used with --shard or --claim")
+        process_all_subfolders(args.batch_folder, args.output_folder, args.stamp_image_path, args.optimise, args.combined, args.fit,
+                               only_rows, sharding, args.engine, args.workers, memory_budget, max_image_pixels)
@@ -0,0 +1,279 @@
+import csv
+import json
+import os
+import re
+import socket
+import threading
+import time
+import zlib
+
+# Splits the person folders of one batch between several machines (or
+# processes) sharing the batch folder over a network share.
+#
+#   row     - static: folder No_ prefix modulo the shard count
+#   hash    - static: CRC32 of the folder name modulo the shard count
+#   claim   - dynamic: each node claims the next free folder by atomically
+#             creating "<folder>.lock"; claims whose heartbeat stops for
+#             stale_seconds are taken over by another node
+#
+# Every node records a "<folder>.done" result file, so one merged summary of
+# all nodes' work can be written at the end. Folders finished "ok" are skipped
+# by later runs; failed ones are retried by the next run (not again in the
+# same run), and reset=True clears the results of the selected folders first. State lives in
+# "<batch>/.shards/<stage>" so the downloaders and run.py can each shard the
+# same batch folder without seeing each other's results.
+
+SHARD_DIR_NAME = '.shards'
+SUMMARY_FILE_NAME = 'summary.csv'
+
+# Function to parse "2/4" (shard 2 of 4, counting from 1) into (2, 4)
+def parse_shard(text):
+    index, count = (int(part) for part in text.split('/'))
+    if not 1 <= index <= count:
+        raise ValueError(f"Shard must look like 1/4 .. 4/4, got {text}")
+    return index, count
+
+def default_node_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+class Sharding:
+    def __init__(self, batch_folder, stage, mode='claim', shard=None, stale_seconds=1800, node_id=None, reset=False):
+        if mode not in ('row', 'hash', 'claim'):
+            raise ValueError(f"Unknown sharding mode: {mode}")
+        if mode != 'claim' and shard is None:
+            raise ValueError("Static sharding needs a shard such as 1/4")
+
+        self.mode = mode
+        self.shard_index, self.shard_count = shard or (1, 1)
+        self.stale_seconds = stale_seconds
+        self.node_id = node_id or default_node_id()
+        self.reset = reset
+        self.started = time.time()
+        self.shard_dir = os.path.join(batch_folder, SHARD_DIR_NAME, stage)
+        os.makedirs(self.shard_dir, exist_ok=True)
+
+        self.heartbeats = {}  # folder name -> (stop event, thread)
+
+    # Folder names come from the spreadsheet, so make them safe as file names
+    def state_path(self, name, suffix):
+        return os.path.join(self.shard_dir, re.sub(r'[\\/:*?"<>|]', '_', str(name)) + suffix)
+
+    def lock_path(self, name):
+        return self.state_path(name, '.lock')
+
+    def done_path(self, name):
+        return self.state_path(name, '.done')
+
+    # Function to read a folder's recorded result, or None if it has none
+    def result(self, name):
+        try:
+            with open(self.done_path(name)) as done_file:
+                return json.load(done_file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    # Finished: done "ok" in any run, or given any result since this run started
+    def is_done(self, name):
+        result = self.result(name)
+        if result is None:
+            return False
+        return result.get('status') == 'ok' or result.get('finished', 0) >= self.started
+
+    # Whether this node should work on a folder (number is its No_ prefix, may be None)
+    def acquire(self, name, number=None):
+        if self.is_done(name):
+            return False
+        if self.mode == 'row':
+            # Spreadsheet numbers may be floats or blank; fall back to the name hash
+            try:
+                key = int(number)
+            except (TypeError, ValueError):
+                key = zlib.crc32(name.encode('utf-8'))
+            return key % self.shard_count == self.shard_index - 1
+        if self.mode == 'hash':
+            return zlib.crc32(name.encode('utf-8')) % self.shard_count == self.shard_index - 1
+        return self.claim(name)
+
+    def claim(self, name):
+        lock_path = self.lock_path(name)
+        for _ in range(2):
+            try:
+                # O_EXCL makes creation atomic: exactly one node wins the claim
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self.take_over_if_stale(lock_path):
+                    return False
+                continue
+
+            with os.fdopen(fd, 'w') as lock_file:
+                json.dump({'node': self.node_id, 'claimed': time.time()}, lock_file)
+
+            # Done check again: another node may have finished between our checks
+            if self.is_done(name):
+                os.remove(lock_path)
+                return False
+            self.start_heartbeat(name)
+            return True
+        return False
+
+    # The lock's mtime and contents, to tell one claim from a newer one at the same path
+    def lock_snapshot(self, path):
+        mtime = os.path.getmtime(path)
+        with open(path, 'rb') as lock_file:
+            return mtime, lock_file.read()
+
+    # Remove a claim whose heartbeat stopped; the rename means only one node can do it
+    def take_over_if_stale(self, lock_path):
+        try:
+            observed = self.lock_snapshot(lock_path)
+        except FileNotFoundError:
+            return True
+        age = time.time() - observed[0]
+        if age < self.stale_seconds:
+            return False
+
+        stale_path = f"{lock_path}.stale-{self.node_id}"
+        try:
+            os.rename(lock_path, stale_path)
+        except OSError:
+            return False
+
+        # Between the check and the rename another node may have recovered the claim
+        # and made a fresh one (or the owner's heartbeat came back); if that is what
+        # was moved, put it back and leave the folder to that node
+        try:
+            renamed = self.lock_snapshot(stale_path)
+        except FileNotFoundError:
+            return False
+        if renamed != observed:
+            self.restore_lock(stale_path, lock_path)
+            return False
+
+        os.remove(stale_path)
+        print(f"Recovered stale claim {os.path.basename(lock_path)} ({age:.0f}s old)")
+        return True
+
+    def restore_lock(self, stale_path, lock_path):
+        try:
+            # A hard link never replaces a lock someone created in the meantime
+            os.link(stale_path, lock_path)
+        except FileExistsError:
+            pass
+        except OSError:
+            if not os.path.exists(lock_path):
+                os.rename(stale_path, lock_path)
+                return
+        os.remove(stale_path)
+
+    # Keep touching the lock file while the folder is being processed
+    def start_heartbeat(self, name):
+        stop = threading.Event()
+        lock_path = self.lock_path(name)
+
+        def beat():
+            while not stop.wait(max(self.stale_seconds / 3, 1)):
+                try:
+                    os.utime(lock_path)
+                except OSError:
+                    continue  # briefly moved aside by a node checking it, or a share hiccup
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        self.heartbeats[name] = (stop, thread)
+
+    # Record the result for a folder and drop the claim
+    def release(self, name, status, output='', error=''):
+        result = {'folder': name, 'status': status, 'output': output, 'error': error,
+                  'node': self.node_id, 'finished': time.time()}
+        done_path = self.done_path(name)
+        with open(done_path + '.tmp', 'w') as done_file:
+            json.dump(result, done_file)
+        os.replace(done_path + '.tmp', done_path)
+
+        if name in self.heartbeats:
+            stop, thread = self.heartbeats.pop(name)
+            stop.set()
+            thread.join()
+            if os.path.exists(self.lock_path(name)):
+                os.remove(self.lock_path(name))
+
+    # Folders (of the given names) that still have no result from any node
+    def pending(self, names):
+        return [name for name in names if not self.is_done(name)]
+
+    # Yield the items this node should process, from (name, number, item) tuples.
+    # Every yielded item must be release()d. In claim mode this keeps polling
+    # until every item has a result, so folders claimed by a node that died are
+    # picked up here once their claim goes stale.
+    def select(self, items, poll_seconds=10):
+        names = [name for name, _, _ in items]
+        if self.reset:
+            for name in names:
+                if os.path.exists(self.done_path(name)):
+                    os.remove(self.done_path(name))
+            print(f"Cleared earlier results for {len(names)} folders")
+        else:
+            finished = len(names) - len(self.pending(names))
+            if finished:
+                print(f"Skipping {finished} folders already finished ok (--reset redoes them)")
+        while True:
+            for name, number, item in items:
+                if self.acquire(name, number):
+                    yield item
+            if self.mode != 'claim':
+                return
+
+            waiting = self.pending(names)
+            if not waiting:
+                return
+            print(f"Waiting for {len(waiting)} folders still being processed (here or by other nodes)...")
+            time.sleep(poll_seconds)
+
+    # Merge every node's results into one summary; returns its path.
+    # Pass the batch's folder names to also report what is still pending.
+    def write_summary(self, names=None):
+        results = []
+        for file_name in sorted(os.listdir(self.shard_dir)):
+            if file_name.endswith('.done'):
+                with open(os.path.join(self.shard_dir, file_name)) as done_file:
+                    results.append(json.load(done_file))
+
+        summary_path = os.path.join(self.shard_dir, SUMMARY_FILE_NAME)
+        temp_path = f"{summary_path}.{self.node_id}.tmp"
+        with open(temp_path, 'w', newline='') as summary_file:
+            writer = csv.DictWriter(summary_file, fieldnames=['folder', 'status', 'output', 'error', 'node', 'finished'])
+            writer.writeheader()
+            writer.writerows(results)
+        os.replace(temp_path, summary_path)
+
+        by_node = {}
+        for result in results:
+            by_node.setdefault(result['node'], []).append(result['status'])
+        print(f"\nShard summary ({len(results)} folders) written to {summary_path}")
+        for node, statuses in sorted(by_node.items()):
+            print(f"  {node}: {statuses.count('ok')} ok, {len(statuses) - statuses.count('ok')} other")
+        if names is not None:
+            waiting = self.pending(names)
+            if waiting:
+                print(f"  {len(waiting)} folders not finished yet (other shards still running?)")
+        return summary_path
+
+# Function to add the sharding options to a script's argparse parser
+def add_shard_arguments(parser):
+    parser.add_argument("--shard", metavar="I/N", help="Only take shard I of N (e.g. 2/4), split by --shard-by")
+    parser.add_argument("--shard-by", choices=["row", "hash"], default="row",
+                        help="Split static shards by No_ row number or by a hash of the folder name")
+    parser.add_argument("--claim", action="store_true",
+                        help="Share the batch with other machines by claiming folders as they go (lock files in the batch folder)")
+    parser.add_argument("--stale", type=float, default=1800,
+                        help="Seconds without a heartbeat before another node's claim is taken over (--claim)")
+    parser.add_argument("--reset", action="store_true",
+                        help="Redo the selected folders even if an earlier run finished them ok (start it on one node only)")
+
+# Function to build a Sharding from those options, or None when not sharding
+def sharding_from_args(args, batch_folder, stage):
+    if args.claim:
+        return Sharding(batch_folder, stage, 'claim', stale_seconds=args.stale, reset=args.reset)
+    if args.shard:
+        return Sharding(batch_folder, stage, args.shard_by, parse_shard(args.shard), reset=args.reset)
+    return None
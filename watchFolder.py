@@ -0,0 +1,305 @@
+import json
+import os
+import threading
+import time
+
+from run import find_layout_and_images, endorsed_output_path
+from memoryScheduler import MemoryScheduler, ImageTooLargeError
+
+# Long-running endorsement mode. Watches a root folder holding "Batch NN"
+# folders and endorses each person folder once it has a layout PDF plus
+# images and nothing in it has changed for settle_seconds. Output for
+# "Batch NN" goes to "<output root>/Batch NN Endorsed".
+#
+# File events come from watchdog (inotify on Linux, ReadDirectoryChangesW on
+# Windows) when it is installed; the folder tree is also rescanned every
+# rescan_seconds, which on its own is the fallback when watchdog is missing
+# and catches events network shares don't deliver.
+#
+# The signature each person folder was endorsed with is saved in the batch's
+# "<batch>/.watch" folder, so a restarted watcher only redoes folders that
+# changed. Folders that fail are retried with a growing delay, and left alone
+# after MAX_ATTEMPTS until their contents change.
+
+# Files we write ourselves while working in a person folder
+IGNORED_SUFFIXES = ('_stamped.pdf', '.tmp')
+
+# A download still being streamed (renamed to its real name once verified)
+DOWNLOADING_SUFFIX = '.part'
+
+# Bookkeeping for the watcher inside each batch folder (dot folders are never people)
+WATCH_DIR_NAME = '.watch'
+PROCESSED_FILE_NAME = 'processed.json'
+
+# Retry delays for a folder whose endorsement failed: 1 min, doubling up to 1 hour
+RETRY_SECONDS = 60
+MAX_RETRY_SECONDS = 3600
+MAX_ATTEMPTS = 5
+
+def is_ignored_file(file_name):
+    return file_name.lower().endswith(IGNORED_SUFFIXES)
+
+def is_downloading_file(file_name):
+    return file_name.lower().endswith(DOWNLOADING_SUFFIX)
+
+# Function to fingerprint a person folder's contents (name, size, mtime of each file)
+# Returns (signature, newest mtime, whether a download is still in progress)
+def folder_signature(person_folder):
+    entries = []
+    newest = 0
+    downloading = False
+    with os.scandir(person_folder) as it:
+        for entry in it:
+            if not entry.is_file() or is_ignored_file(entry.name):
+                continue
+            stat = entry.stat()
+            newest = max(newest, stat.st_mtime)
+            if is_downloading_file(entry.name):
+                downloading = True
+                continue
+            entries.append((entry.name, stat.st_size, stat.st_mtime_ns))
+    return tuple(sorted(entries)), newest, downloading
+
+def processed_state_path(batch_folder):
+    return os.path.join(batch_folder, WATCH_DIR_NAME, PROCESSED_FILE_NAME)
+
+# Function to load the saved {person folder name: signature} for a batch ({} if there is none)
+def load_processed(batch_folder):
+    try:
+        with open(processed_state_path(batch_folder), encoding='utf-8') as state_file:
+            saved = json.load(state_file)
+    except (OSError, ValueError):
+        return {}
+    return {name: tuple(tuple(entry) for entry in signature) for name, signature in saved.items()}
+
+def save_processed(batch_folder, processed):
+    state_path = processed_state_path(batch_folder)
+    os.makedirs(os.path.dirname(state_path), exist_ok=True)
+    with open(state_path + '.tmp', 'w', encoding='utf-8') as state_file:
+        json.dump(processed, state_file)
+    os.replace(state_path + '.tmp', state_path)
+
+class BatchWatcher:
+    def __init__(self, batch_root, output_root, stamp_image_path, settle_seconds=30,
+                 rescan_seconds=60, workers=None, optimise=False, fit_to_page=False, engine=None, memory_budget=None,
+                 max_image_pixels=None):
+        self.batch_root = os.path.abspath(batch_root)
+        self.output_root = os.path.abspath(output_root)
+        self.stamp_image_path = stamp_image_path
+        self.settle_seconds = settle_seconds
+        self.rescan_seconds = rescan_seconds
+        self.workers = workers
+        self.optimise = optimise
+        self.fit_to_page = fit_to_page
+        self.engine = engine
+        self.memory_budget = memory_budget
+        self.max_image_pixels = max_image_pixels
+
+        self.last_activity = {}  # person folder -> time of the last change seen
+        self.processed = {}      # person folder -> signature it was endorsed with
+        self.loaded_batches = set()  # batch folders whose saved signatures are in self.processed
+        self.failures = {}       # person folder -> (signature, attempts, time of the next retry)
+        self.in_progress = {}    # future -> (person folder, signature)
+        self.lock = threading.Lock()
+
+    # Map a path anywhere below the root to its person folder (root/batch/person), if any
+    def person_folder_for(self, path):
+        relative = os.path.relpath(os.path.abspath(path), self.batch_root)
+        parts = relative.split(os.sep)
+        if relative.startswith('..') or len(parts) < 2 or parts[0].endswith(' Endorsed') or parts[1].startswith('.'):
+            return None
+        return os.path.join(self.batch_root, parts[0], parts[1])
+
+    # Called for every file event (and by rescans) to restart a folder's quiet timer
+    def note_activity(self, path, when=None):
+        if is_ignored_file(os.path.basename(path)):
+            return
+        person_folder = self.person_folder_for(path)
+        if person_folder is None:
+            return
+        with self.lock:
+            self.last_activity[person_folder] = max(self.last_activity.get(person_folder, 0), when or time.time())
+
+    # Walk root/batch/person once and note any folder whose contents changed
+    def rescan(self):
+        try:
+            with os.scandir(self.batch_root) as batches:
+                batch_folders = [batch.path for batch in batches
+                                 if batch.is_dir() and not batch.name.endswith(' Endorsed')]
+        except OSError as e:
+            print(f"Could not scan {self.batch_root}: {e}")
+            return
+
+        # A folder removed or unreadable mid-scan (common on network shares) is skipped until the next rescan
+        for batch_folder in batch_folders:
+            self.load_batch(batch_folder)
+            try:
+                with os.scandir(batch_folder) as people:
+                    person_folders = [person.path for person in people if person.is_dir() and not person.name.startswith('.')]
+            except OSError as e:
+                print(f"Could not scan {batch_folder}: {e}")
+                continue
+
+            for person_folder in person_folders:
+                try:
+                    signature, newest, downloading = folder_signature(person_folder)
+                except OSError as e:
+                    print(f"Could not scan {person_folder}: {e}")
+                    continue
+                if downloading or (signature and signature != self.processed.get(person_folder)):
+                    self.note_activity(os.path.join(person_folder, '.'), newest)
+
+    # Pick up what an earlier run of the watcher already endorsed in this batch
+    def load_batch(self, batch_folder):
+        if batch_folder in self.loaded_batches:
+            return
+        self.loaded_batches.add(batch_folder)
+        saved = load_processed(batch_folder)
+        for name, signature in saved.items():
+            self.processed.setdefault(os.path.join(batch_folder, name), signature)
+        if saved:
+            print(f"{os.path.basename(batch_folder)}: {len(saved)} folders already endorsed by an earlier run")
+
+    # Record a folder as done (endorsed, or refused until its contents change) and save its batch's record
+    def mark_processed(self, person_folder, signature):
+        self.processed[person_folder] = signature
+        self.failures.pop(person_folder, None)
+
+        batch_folder = os.path.dirname(person_folder)
+        batch_processed = {os.path.basename(folder): folder_signature
+                           for folder, folder_signature in self.processed.items() if os.path.dirname(folder) == batch_folder}
+        try:
+            save_processed(batch_folder, batch_processed)
+        except OSError as e:
+            print(f"Could not save the processed folders of {batch_folder}: {e}")
+
+    # Back off from a folder that failed with these contents; gives up after MAX_ATTEMPTS
+    def mark_failed(self, person_folder, signature):
+        previous_signature, attempts, _ = self.failures.get(person_folder, (None, 0, 0))
+        attempts = attempts + 1 if previous_signature == signature else 1
+        delay = min(RETRY_SECONDS * 2 ** (attempts - 1), MAX_RETRY_SECONDS)
+        self.failures[person_folder] = (signature, attempts, time.time() + delay)
+        if attempts >= MAX_ATTEMPTS:
+            print(f"Giving up on {person_folder} after {attempts} attempts until its files change")
+        else:
+            print(f"Retrying {person_folder} in {delay}s (attempt {attempts} of {MAX_ATTEMPTS})")
+
+    def waiting_to_retry(self, person_folder, signature):
+        if person_folder not in self.failures:
+            return False
+        failed_signature, attempts, retry_at = self.failures[person_folder]
+        if failed_signature != signature:
+            return False  # Changed since it failed: try again straight away
+        return attempts >= MAX_ATTEMPTS or time.time() < retry_at
+
+    # Person folders that have been quiet for settle_seconds and are ready to endorse
+    def ready_folders(self):
+        now = time.time()
+        busy = {folder for folder, _ in self.in_progress.values()}
+        with self.lock:
+            quiet = [folder for folder, last in self.last_activity.items()
+                     if now - last >= self.settle_seconds and folder not in busy]
+
+        ready = []
+        for person_folder in quiet:
+            with self.lock:
+                self.last_activity.pop(person_folder, None)
+            if not os.path.isdir(person_folder):
+                continue
+
+            try:
+                signature, _, downloading = folder_signature(person_folder)
+                if downloading:
+                    # A file is still being downloaded; look again once the folder is quiet
+                    self.note_activity(os.path.join(person_folder, '.'))
+                    continue
+                if signature == self.processed.get(person_folder) or self.waiting_to_retry(person_folder, signature):
+                    continue
+                layout_pdf, image_files = find_layout_and_images(person_folder)
+            except OSError as e:
+                # Removed or unreadable since it was last seen; a later change or rescan brings it back
+                print(f"Skipping {person_folder}: {e}")
+                continue
+
+            if layout_pdf and image_files:
+                ready.append((person_folder, signature, layout_pdf, image_files))
+        return ready
+
+    def submit_ready(self, scheduler):
+        for person_folder, signature, layout_pdf, image_files in self.ready_folders():
+            batch_name = os.path.basename(os.path.dirname(person_folder))
+            output_folder = os.path.join(self.output_root, f"{batch_name} Endorsed")
+            os.makedirs(output_folder, exist_ok=True)
+
+            future = scheduler.submit(layout_pdf, image_files, self.stamp_image_path, endorsed_output_path(layout_pdf, output_folder),
+                                      self.optimise, self.fit_to_page, self.engine)
+            self.in_progress[future] = (person_folder, signature)
+            print(f"Endorsing {person_folder}")
+
+    def collect_finished(self):
+        for future in [future for future in self.in_progress if future.done()]:
+            person_folder, signature = self.in_progress.pop(future)
+            try:
+                future.result()
+                self.mark_processed(person_folder, signature)
+                print(f"Processed {person_folder}")
+            except ImageTooLargeError as e:
+                # Retrying won't help until the photo is replaced, which changes the signature
+                self.mark_processed(person_folder, signature)
+                print(f"Refused {person_folder}: {e}")
+            except Exception as e:
+                # Leave it unprocessed; a later rescan retries it once the backoff has passed
+                print(f"Failed to endorse {person_folder}: {e}")
+                self.mark_failed(person_folder, signature)
+
+    # Start watchdog if it's installed; returns the observer or None
+    def start_observer(self):
+        try:
+            from watchdog.observers import Observer
+            from watchdog.events import FileSystemEventHandler
+        except ImportError:
+            print("watchdog not installed, watching by polling the folder tree")
+            return None
+
+        watcher = self
+
+        class ActivityHandler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                watcher.note_activity(event.src_path)
+                if getattr(event, 'dest_path', None):
+                    watcher.note_activity(event.dest_path)
+
+        observer = Observer()
+        observer.schedule(ActivityHandler(), self.batch_root, recursive=True)
+        observer.start()
+        return observer
+
+    def run(self, poll_seconds=1):
+        os.makedirs(self.output_root, exist_ok=True)
+        observer = self.start_observer()
+        rescan_seconds = self.rescan_seconds if observer else min(self.rescan_seconds, self.settle_seconds)
+
+        print(f"Watching {self.batch_root} (settle time {self.settle_seconds}s), press Ctrl+C to stop")
+        next_rescan = 0
+        try:
+            # Parallel endorsements are scheduled against a memory budget (see memoryScheduler)
+            with MemoryScheduler(self.workers, self.memory_budget, self.max_image_pixels) as scheduler:
+                while True:
+                    if time.time() >= next_rescan:
+                        self.rescan()
+                        next_rescan = time.time() + rescan_seconds
+                    self.collect_finished()
+                    self.submit_ready(scheduler)
+                    time.sleep(poll_seconds)
+        except KeyboardInterrupt:
+            print("Stopping watcher")
+        finally:
+            if observer:
+                observer.stop()
+                observer.join()
+
+def watch_batch_root(batch_root, output_root, stamp_image_path, settle_seconds=30, workers=None, optimise=False, fit_to_page=False,
+                     engine=None, memory_budget=None, max_image_pixels=None):
+    BatchWatcher(batch_root, output_root, stamp_image_path, settle_seconds, workers=workers,
+                 optimise=optimise, fit_to_page=fit_to_page, engine=engine, memory_budget=memory_budget,
+                 max_image_pixels=max_image_pixels).run()